@@ -0,0 +1,165 @@
+#coding:utf-8
+"""
+Benchmarks the cluster lifecycle (provision, test SSH, stop, snapshot, teardown) against the in-process fake of the
+Azure APIs in fake_azure.py, so that performance regressions and speedups can be measured without a Subscription:
+
+    python benchmark.py --sizes 1,10,50,200 --time-scale 0.01
+
+For each cluster size, this reports how long each phase took and how many API calls it made, along with how long it
+took for each VM to be ready (answer on SSH) since the start of provisioning. Durations are reported in "Azure
+seconds": the fake runs `1 / time_scale` times faster than Azure, and so do our poll intervals and rate limits.
+"""
+import argparse
+import logging
+import time
+
+from attrdict import AttrDict
+
+import main
+from fake_azure import FakeAzure
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_config(n_vms, n_shards, time_scale):
+    config = {
+        "service_management": {"requests_per_second": 10 / time_scale},
+        "storage": {"requests_per_second": 50 / time_scale},
+        "containers": {"vhds": "vhds", "images": "images"},
+        "service_name": "bench",
+        "service_location": "West US",
+        "deployment_name": "bench",
+        "network_name": "bench-net",
+        "n_vms": n_vms,
+    }
+    if n_shards > 1:
+        config["shards"] = {"count": n_shards, "service_name_tpl": "bench-{shard}", "deployment_name_tpl": "bench-{shard}"}
+    return AttrDict(config)
+
+
+VM_CONFIG = AttrDict({
+    "net": {
+        "nat_ports": [
+            {"name": "ssh", "protocol": "tcp", "port": 22, "lb": False},
+            {"name": "http", "protocol": "tcp", "port": 80, "lb": True},
+        ],
+        "subnet_names": ["Subnet-1"],
+        "public_ip_name_tpls": [],
+    },
+    "root_disk": {
+        "source_image": "b39f27a8b8c64d52b05eac6a62ebad85__Ubuntu-14_04_1-LTS-amd64-server-20141125-en-us-30GB",
+        "name_tpl": "os-disk-{vm_name}",
+    },
+    "data_disks": [
+        {"url_tpl": "https://fakeaccount.blob.core.windows.net/vhds/data-a-{vm_name}.vhd", "size_gb": 10},
+    ],
+    "system": {
+        "host_name_tpl": "{vm_name}",
+        "user_data_tpl": "#cloud-config\npackages:\n  - apache2",
+    },
+    "size": "Small",
+})
+
+SNAPSHOT_CONFIG = AttrDict({
+    "label_tpl": "Benchmark image from {role.role_name}",
+    "name_tpl": "bench-from-{role.role_name}",
+    "os": "Linux",
+})
+
+
+class Phase(object):
+
+    def __init__(self, name, duration, api_calls, throttled):
+        self.name = name
+        self.duration = duration
+        self.api_calls = api_calls
+        self.throttled = throttled
+
+
+def run(n_vms, n_shards=1, time_scale=0.01, pipeline=False):
+    """
+    Run the lifecycle of a cluster of `n_vms` VMs against a new fake. Returns the list of Phases and the list of
+    times it took each VM to be ready, both in Azure seconds.
+    """
+    azure = FakeAzure(time_scale=time_scale)
+    config = make_config(n_vms, n_shards, time_scale)
+    sms, bs, tracker = main.setup_services(azure.sms, azure.bs, config, poll_interval=0.5 * time_scale,
+                                           max_poll_interval=10 * time_scale)
+    prober = main.SSHProber(initial_backoff=1 * time_scale, max_backoff=30 * time_scale)
+    bs.create_container(config.containers.images, fail_on_exist=False)
+    copy_watcher = main.BlobCopyWatcher(bs, config.containers.images, prefix=main.SNAPSHOT_BLOB_PREFIX,
+                                        poll_interval=5 * time_scale)
+    shards = main.get_shards(config)
+    phases = []
+
+    def phase(name, fn):
+        calls, throttled = azure.api_calls(), sum(azure.throttled.values())
+        started_at = time.time()
+        fn()
+        phases.append(Phase(name, (time.time() - started_at) / time_scale, azure.api_calls() - calls,
+                            sum(azure.throttled.values()) - throttled))
+
+    started_at = time.time()
+    try:
+        phase("provision", lambda: main.provision_cluster(sms, bs, tracker, config, shards, main.VMTemplate(VM_CONFIG),
+                                                          pipelined=pipeline, prober=prober, copy_watcher=copy_watcher,
+                                                          snapshot_config=SNAPSHOT_CONFIG))
+        if not pipeline:
+            phase("test-ssh", lambda: main.test_ssh(sms, shards, prober))
+            phase("stop", lambda: main.wait_for_all([main.stop(sms, tracker, service_name, deployment_name)
+                                                     for service_name, deployment_name in shards]))
+            phase("snapshot", lambda: main.snapshot(sms, tracker, copy_watcher, shards, SNAPSHOT_CONFIG))
+        phase("teardown", lambda: main.teardown(sms, tracker, sorted(set(service_name for service_name, _ in shards)),
+                                                poll_interval=5 * time_scale))
+    finally:
+        tracker.close()
+        copy_watcher.close()
+        azure.close()
+
+    time_to_ready = [(at - started_at) / time_scale for at in azure.ssh.first_banner_at.values()]
+    if len(time_to_ready) != n_vms:
+        logger.warning("Only %s out of %s VMs were seen answering on SSH", len(time_to_ready), n_vms)
+    if azure.disks:
+        logger.warning("%s Disks were left behind", len(azure.disks))
+
+    return phases, time_to_ready
+
+
+def report(n_vms, phases, time_to_ready):
+    print("")
+    print("{0} VM(s)".format(n_vms))
+    print("  {0:<10} {1:>12} {2:>10} {3:>10}".format("phase", "duration (s)", "API calls", "throttled"))
+    for phase in phases:
+        print("  {0:<10} {1:>12.0f} {2:>10} {3:>10}".format(phase.name, phase.duration, phase.api_calls,
+                                                         phase.throttled))
+    print("  {0:<10} {1:>12.0f} {2:>10} {3:>10}".format("total", sum(phase.duration for phase in phases),
+                                                     sum(phase.api_calls for phase in phases),
+                                                     sum(phase.throttled for phase in phases)))
+    if time_to_ready:
+        print("  time to ready (s): p50 {0:.0f}, p95 {1:.0f}, max {2:.0f}".format(
+            main.percentile(time_to_ready, 50), main.percentile(time_to_ready, 95), max(time_to_ready)))
+
+
+def benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1,10,50,200", help="Comma-separated cluster sizes to benchmark")
+    parser.add_argument("--shards", type=int, default=1, help="Number of Hosted Services to spread the VMs across")
+    parser.add_argument("--pipeline", action="store_true", help="Test SSH on / snapshot each VM as it's provisioned")
+    parser.add_argument("--time-scale", type=float, default=0.01,
+                        help="How much faster than Azure the fake runs (0.01 means an Azure minute is 0.6s)")
+    parser.add_argument("--verbose", action="store_true", help="Show the logs of the lifecycle functions")
+    ns = parser.parse_args()
+
+    # The lifecycle functions log (and warn about) every VM.
+    logging.getLogger().setLevel(logging.DEBUG if ns.verbose else logging.WARNING)
+    if not ns.verbose:
+        logging.getLogger(main.__name__).setLevel(logging.ERROR)
+
+    for n_vms in [int(size) for size in ns.sizes.split(",")]:
+        phases, time_to_ready = run(n_vms, ns.shards, ns.time_scale, ns.pipeline)
+        report(n_vms, phases, time_to_ready)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,949 @@
+#coding:utf-8
+"""
+An in-process stand-in for the Azure Service Management and Blob Storage APIs, so that the lifecycle functions in
+main.py (`deploy_vm`, `test_ssh`, `snapshot`, `teardown`, ...) can be run (and benchmarked) without a Subscription.
+
+    azure = FakeAzure(time_scale=0.01)
+    sms, bs, tracker = setup_services(azure.sms, azure.bs, config)
+    ...
+    azure.close()
+
+Only the subset of the API that main.py uses is implemented, and it returns the same data classes as the SDK. What
+the fake tries to get right is the behavior that matters for performance:
+
+  + Every call takes a while (`call_latency`), and the API is throttled (`throttle_rate`): calls over the limit fail
+    with a 503, like they do in Azure.
+  + VM operations are asynchronous: they take a while to complete (`operation_durations`), and Azure only runs one
+    of them at a time in a given Deployment (others fail with a 409 Conflict).
+  + VMs take a while to boot after they're provisioned or started (`boot_delay`). Each VM gets a local port that
+    answers with an SSH banner once it's booted, so that `test_ssh` can actually connect to something.
+  + Disks remain attached for a while after their VM is deleted (`detach_delay`).
+  + Blob copies are performed "server-side", at `copy_throughput` bytes per second.
+  + Page writes take a while to upload, at `upload_throughput` bytes per second (per connection).
+
+All the durations are multiplied by `time_scale`, so that a full lifecycle can run in seconds rather than hours.
+"""
+import collections
+import email.utils
+import errno
+import itertools
+import math
+import random
+import select
+import socket
+import threading
+import time
+import urlparse
+import uuid
+
+from azure import WindowsAzureError, WindowsAzureConflictError, WindowsAzureMissingResourceError
+from azure.servicemanagement import AsynchronousOperationResult, AttachedTo, DataVirtualHardDisk, Deployment, Disk, \
+    HostedService, InstanceEndpoint, Operation, OSImage, OSVirtualHardDisk, Role, RoleInstance
+from azure.storage import Blob, BlobEnumResults, PageList, PageRange
+
+
+class Latency(object):
+    """
+    A log-normal distribution of durations (in seconds), which is a decent model for API latencies: most calls take
+    about `median`, and a few take much longer.
+    """
+
+    def __init__(self, median, spread=0.5):
+        self.median = median
+        self.spread = spread
+
+    def sample(self):
+        if not self.median:
+            return 0
+        return random.lognormvariate(math.log(self.median), self.spread)
+
+
+# Ballpark figures for the classic Service Management API.
+DEFAULT_CALL_LATENCY = Latency(0.3)
+DEFAULT_OPERATION_DURATIONS = {
+    "create_virtual_machine_deployment": Latency(120),
+    "add_role": Latency(90),
+    "delete_role": Latency(40),
+    "delete_deployment": Latency(60),
+    "start_roles": Latency(40),
+    "shutdown_roles": Latency(40),
+    "add_os_image": Latency(15),
+}
+DEFAULT_BOOT_DELAY = Latency(45)
+DEFAULT_DETACH_DELAY = Latency(90)
+DEFAULT_COPY_THROUGHPUT = 60 * 2 ** 20
+DEFAULT_UPLOAD_THROUGHPUT = 8 * 2 ** 20
+
+OS_DISK_SIZE_GB = 30
+SSH_BANNER = b"SSH-2.0-OpenSSH_6.6.1p1 Ubuntu-2ubuntu2\r\n"
+
+
+class FakeAzure(object):
+    """
+    The state of a fake Subscription and Storage Account. Use `.sms` and `.bs` in lieu of a ServiceManagementService
+    and a BlobService. `.calls` counts the API calls that were made, by method name.
+    """
+
+    def __init__(self, time_scale=1.0, call_latency=DEFAULT_CALL_LATENCY, operation_durations=None,
+                 boot_delay=DEFAULT_BOOT_DELAY, detach_delay=DEFAULT_DETACH_DELAY,
+                 copy_throughput=DEFAULT_COPY_THROUGHPUT, upload_throughput=DEFAULT_UPLOAD_THROUGHPUT, throttle_rate=20, throttle_burst=40, storage_throttle_rate=500,
+                 error_rate=0, storage_account="fakeaccount"):
+        self.time_scale = time_scale
+        self.call_latency = call_latency
+        self.operation_durations = dict(DEFAULT_OPERATION_DURATIONS, **(operation_durations or {}))
+        self.boot_delay = boot_delay
+        self.detach_delay = detach_delay
+        self.copy_throughput = copy_throughput
+        self.upload_throughput = upload_throughput
+        self.error_rate = error_rate
+        self.storage_account = storage_account
+
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+
+        # Everything below is protected by the lock.
+        self.lock = threading.RLock()
+        self.services = {}  # name -> _Service
+        self.disks = {}  # name -> _Disk
+        self.images = {}  # name -> OSImage
+        self.operations = {}  # request id -> _Operation
+        self.containers = set()
+        self.blobs = {}  # (container, name) -> _Blob
+
+        self.ssh = SSHBannerListener()
+        self.sms = FakeServiceManagementService(self, _Throttle(throttle_rate / time_scale, throttle_burst))
+        self.bs = FakeBlobService(self, _Throttle(storage_throttle_rate / time_scale, storage_throttle_rate))
+
+    def close(self):
+        self.ssh.close()
+
+    def duration(self, latency):
+        return latency.sample() * self.time_scale
+
+    def api_calls(self):
+        return sum(self.calls.values())
+
+    def call(self, name, throttle):
+        """
+        Account for an API call: wait for its latency, and fail it if it's throttled.
+        """
+        with self.lock:
+            self.calls[name] += 1
+        time.sleep(self.duration(self.call_latency))
+
+        if not throttle.take():
+            with self.lock:
+                self.throttled[name] += 1
+            raise WindowsAzureError("Unknown error (Service Unavailable)\n<Error><Code>TooManyRequests</Code>"
+                                    "<Message>The request rate is too high.</Message></Error>")
+        if self.error_rate and random.random() < self.error_rate:
+            raise WindowsAzureError("Unknown error (Internal Server Error)")
+
+        self.advance()
+
+    def advance(self):
+        """
+        Complete the operations that are due. The fake has no threads of its own: its state is brought up to date on
+        every call instead.
+        """
+        now = time.time()
+        with self.lock:
+            due = sorted((op for op in self.operations.values() if op.status == "InProgress" and op.done_at <= now),
+                         key=lambda op: op.done_at)
+            for op in due:
+                if op.deployment is not None:
+                    op.deployment.busy_with = None
+                try:
+                    op.apply()
+                except WindowsAzureError as e:
+                    code = "ConflictError" if isinstance(e, WindowsAzureConflictError) else "BadRequest"
+                    op.status, op.error = "Failed", (code, str(e).split("\n")[-1])
+                else:
+                    op.status = "Succeeded"
+
+    def start_operation(self, name, apply, deployment=None):
+        """
+        Start an asynchronous operation, which will run `apply` when it completes. Operations on a Deployment are
+        exclusive.
+        """
+        with self.lock:
+            if deployment is not None:
+                if deployment.busy_with is not None:
+                    raise WindowsAzureConflictError(
+                        "Conflict (Conflict)\n<Error><Code>ConflictError</Code><Message>Windows Azure is currently "
+                        "performing an operation with x-ms-requestid {0} on this deployment that requires exclusive "
+                        "access.</Message></Error>".format(deployment.busy_with))
+
+            request_id = uuid.uuid4().hex
+            op = _Operation(time.time() + self.duration(self.operation_durations[name]), apply, deployment)
+            self.operations[request_id] = op
+            if deployment is not None:
+                deployment.busy_with = request_id
+
+        return AsynchronousOperationResult(request_id)
+
+    def blob_url(self, container_name, blob_name):
+        return "https://{0}.blob.core.windows.net/{1}/{2}".format(self.storage_account, container_name, blob_name)
+
+    def parse_blob_url(self, url):
+        path = urlparse.urlparse(url).path.lstrip("/")
+        container_name, _, blob_name = path.partition("/")
+        return container_name, blob_name
+
+
+class _Throttle(object):
+    # A token bucket that rejects (rather than delays) the calls it doesn't have tokens for.
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class _Operation(object):
+
+    def __init__(self, done_at, apply, deployment):
+        self.done_at = done_at
+        self.apply = apply
+        self.deployment = deployment
+        self.status = "InProgress"
+        self.error = None
+
+
+class _Service(object):
+
+    def __init__(self, name, label, location):
+        self.name = name
+        self.label = label
+        self.location = location
+        self.deployments = collections.OrderedDict()
+
+
+class _Deployment(object):
+
+    def __init__(self, name, label, network_name):
+        self.name = name
+        self.label = label
+        self.network_name = network_name
+        self.roles = collections.OrderedDict()
+        self.pending = []  # Roles that are being created
+        self.busy_with = None
+
+
+class _Role(object):
+
+    def __init__(self, name, size, os_disk, data_disks, network_config):
+        self.name = name
+        self.size = size
+        self.os_disk = os_disk
+        self.data_disks = data_disks
+        self.network_config = network_config
+        self.status = "Provisioning"  # Or one of the stopped statuses
+        self.ready_at = None
+
+
+class _Disk(object):
+
+    def __init__(self, name, media_link, size_gb, os=None, source_image_name=None):
+        self.name = name
+        self.media_link = media_link
+        self.size_gb = size_gb
+        self.os = os
+        self.source_image_name = source_image_name
+        self.attached_to = None  # (service, deployment, role)
+        self.detached_at = None
+
+
+class _Blob(object):
+
+    def __init__(self, size, blob_type="PageBlob"):
+        self.size = size
+        self.blob_type = blob_type
+        self.copy_id = None
+        self.copy_source = None
+        self.copy_done_at = None
+        self.pages = []  # Sorted, non-overlapping (start, end) ranges of pages that were written (end excluded)
+        self.metadata = {}
+        self.modified_at = time.time()
+
+    def copy_pending(self):
+        return self.copy_done_at is not None and self.copy_done_at > time.time()
+
+    def write_pages(self, start, end):
+        # Merge the new range with the ranges it overlaps or touches, like Azure does.
+        pages = []
+        for page_start, page_end in self.pages:
+            if page_end < start or page_start > end:
+                pages.append((page_start, page_end))
+            else:
+                start, end = min(start, page_start), max(end, page_end)
+        pages.append((start, end))
+        self.pages = sorted(pages)
+        self.modified_at = time.time()
+
+
+class FakeServiceManagementService(object):
+
+    def __init__(self, azure, throttle):
+        self.azure = azure
+        self.throttle = throttle
+
+    def _call(self, name):
+        self.azure.call(name, self.throttle)
+
+    ###################
+    # Hosted Services #
+    ###################
+
+    def create_hosted_service(self, service_name, label, description=None, location=None, affinity_group=None,
+                              extended_properties=None):
+        self._call("create_hosted_service")
+        with self.azure.lock:
+            if service_name in self.azure.services:
+                raise WindowsAzureConflictError("Conflict (Conflict)\nThe specified DNS name is already taken.")
+            self.azure.services[service_name] = _Service(service_name, label, location)
+
+    def delete_hosted_service(self, service_name):
+        self._call("delete_hosted_service")
+        with self.azure.lock:
+            service = self._service(service_name)
+            if service.deployments:
+                raise WindowsAzureConflictError("Conflict (Conflict)\nThe hosted service has deployments.")
+            del self.azure.services[service_name]
+
+    def get_hosted_service_properties(self, service_name, embed_detail=False):
+        self._call("get_hosted_service_properties")
+        with self.azure.lock:
+            service = self._service(service_name)
+            result = HostedService()
+            result.service_name = service.name
+            result.hosted_service_properties.label = service.label
+            result.hosted_service_properties.location = service.location
+            result.hosted_service_properties.status = "Created"
+            if embed_detail:
+                for deployment in service.deployments.values():
+                    result.deployments.deployments.append(self._deployment(service, deployment))
+            return result
+
+    ###############
+    # Deployments #
+    ###############
+
+    def get_deployment_by_name(self, service_name, deployment_name):
+        self._call("get_deployment_by_name")
+        with self.azure.lock:
+            service = self._service(service_name)
+            return self._deployment(service, self._get_deployment(service, deployment_name))
+
+    def create_virtual_machine_deployment(self, service_name, deployment_name, deployment_slot, label, role_name,
+                                          system_config, os_virtual_hard_disk, network_config=None,
+                                          availability_set_name=None, data_virtual_hard_disks=None, role_size=None,
+                                          role_type='PersistentVMRole', virtual_network_name=None, **kwargs):
+        self._call("create_virtual_machine_deployment")
+        with self.azure.lock:
+            service = self._service(service_name)
+            if service.deployments:
+                raise WindowsAzureConflictError("Conflict (Conflict)\nA deployment already exists in this slot.")
+            deployment = _Deployment(deployment_name, label, virtual_network_name)
+            service.deployments[deployment_name] = deployment
+            role = self._new_role(service, deployment, role_name, os_virtual_hard_disk, data_virtual_hard_disks,
+                                  network_config, role_size)
+            # The Deployment shows up right away, but its first Role only exists once the operation completes.
+            return self.azure.start_operation("create_virtual_machine_deployment",
+                                              lambda: self._role_created(service, deployment, role), deployment)
+
+    def add_role(self, service_name, deployment_name, role_name, system_config, os_virtual_hard_disk,
+                 network_config=None, availability_set_name=None, data_virtual_hard_disks=None, role_size=None,
+                 role_type='PersistentVMRole', **kwargs):
+        self._call("add_role")
+        with self.azure.lock:
+            service = self._service(service_name)
+            deployment = self._get_deployment(service, deployment_name)
+            if role_name in deployment.roles:
+                raise WindowsAzureConflictError("Conflict (Conflict)\nA role with this name already exists.")
+            self._check_ports(deployment, network_config)
+            role = self._new_role(service, deployment, role_name, os_virtual_hard_disk, data_virtual_hard_disks,
+                                  network_config, role_size)
+            return self.azure.start_operation("add_role", lambda: self._role_created(service, deployment, role),
+                                              deployment)
+
+    def delete_role(self, service_name, deployment_name, role_name):
+        self._call("delete_role")
+        with self.azure.lock:
+            service = self._service(service_name)
+            deployment = self._get_deployment(service, deployment_name)
+            role = self._get_role(deployment, role_name)
+            if len(deployment.roles) == 1:
+                raise WindowsAzureError("Unknown error (Bad Request)\nThe last role in a deployment can't be deleted.")
+
+            def apply():
+                del deployment.roles[role.name]
+                self._role_deleted(role)
+
+            return self.azure.start_operation("delete_role", apply, deployment)
+
+    def delete_deployment(self, service_name, deployment_name):
+        self._call("delete_deployment")
+        with self.azure.lock:
+            service = self._service(service_name)
+            deployment = self._get_deployment(service, deployment_name)
+
+            def apply():
+                del service.deployments[deployment.name]
+                for role in deployment.roles.values():
+                    self._role_deleted(role)
+
+            return self.azure.start_operation("delete_deployment", apply, deployment)
+
+    def start_roles(self, service_name, deployment_name, role_names):
+        self._call("start_roles")
+        with self.azure.lock:
+            service = self._service(service_name)
+            deployment = self._get_deployment(service, deployment_name)
+            roles = [self._get_role(deployment, role_name) for role_name in role_names]
+
+            def apply():
+                for role in roles:
+                    if role.status != "Provisioning":
+                        self._boot(role)
+
+            return self.azure.start_operation("start_roles", apply, deployment)
+
+    def shutdown_roles(self, service_name, deployment_name, role_names, post_shutdown_action='Stopped'):
+        self._call("shutdown_roles")
+        with self.azure.lock:
+            service = self._service(service_name)
+            deployment = self._get_deployment(service, deployment_name)
+            roles = [self._get_role(deployment, role_name) for role_name in role_names]
+
+            def apply():
+                for role in roles:
+                    role.status = "StoppedVM" if post_shutdown_action == "Stopped" else post_shutdown_action
+                    role.ready_at = None
+                    self.azure.ssh.set_ready_at(role.name, None)
+
+            return self.azure.start_operation("shutdown_roles", apply, deployment)
+
+    ##############
+    # Operations #
+    ##############
+
+    def get_operation_status(self, request_id):
+        self._call("get_operation_status")
+        with self.azure.lock:
+            op = self.azure.operations.get(request_id)
+            if op is None:
+                raise WindowsAzureMissingResourceError("Not found (Not Found)")
+            result = Operation()
+            result.id = request_id
+            result.status = op.status
+            result.http_status_code = "200" if op.status != "Failed" else "400"
+            # Like the SDK's parser, we don't fill in the elements that aren't in the response.
+            if op.error is not None:
+                result.error.code, result.error.message = op.error
+            else:
+                result.error = None
+            return result
+
+    #########
+    # Disks #
+    #########
+
+    def list_disks(self):
+        self._call("list_disks")
+        with self.azure.lock:
+            return [self._disk(disk) for _, disk in sorted(self.azure.disks.items())]
+
+    def get_disk(self, disk_name):
+        self._call("get_disk")
+        with self.azure.lock:
+            if disk_name not in self.azure.disks:
+                raise WindowsAzureMissingResourceError("Not found (Not Found)")
+            return self._disk(self.azure.disks[disk_name])
+
+    def delete_disk(self, disk_name, delete_vhd=False):
+        self._call("delete_disk")
+        with self.azure.lock:
+            disk = self.azure.disks.get(disk_name)
+            if disk is None:
+                raise WindowsAzureMissingResourceError("Not found (Not Found)")
+            if self._attached_to(disk) is not None:
+                raise WindowsAzureConflictError("Conflict (Conflict)\nThe disk is currently in use.")
+            del self.azure.disks[disk_name]
+            if delete_vhd:
+                self.azure.blobs.pop(self.azure.parse_blob_url(disk.media_link), None)
+
+    #############
+    # OS Images #
+    #############
+
+    def list_os_images(self):
+        self._call("list_os_images")
+        with self.azure.lock:
+            return [image for _, image in sorted(self.azure.images.items())]
+
+    def add_os_image(self, label, media_link, name, os):
+        self._call("add_os_image")
+
+        def apply():
+            blob = self.azure.blobs.get(self.azure.parse_blob_url(media_link))
+            if blob is None or blob.copy_pending():
+                raise WindowsAzureError("Unknown error (Bad Request)\nThe blob is not a valid VHD.")
+            if name in self.azure.images:
+                raise WindowsAzureConflictError("Conflict (Conflict)\nAn image with this name already exists.")
+            image = OSImage()
+            image.name, image.label, image.media_link, image.os = name, label, media_link, os
+            image.logical_size_in_gb = blob.size // 2 ** 30
+            image.category = "User"
+            self.azure.images[name] = image
+
+        return self.azure.start_operation("add_os_image", apply)
+
+    def delete_os_image(self, image_name, delete_vhd=False):
+        self._call("delete_os_image")
+        with self.azure.lock:
+            image = self.azure.images.pop(image_name, None)
+            if image is None:
+                raise WindowsAzureMissingResourceError("Not found (Not Found)")
+            if delete_vhd:
+                self.azure.blobs.pop(self.azure.parse_blob_url(image.media_link), None)
+
+    ###########
+    # Helpers #
+    ###########
+
+    def _service(self, service_name):
+        service = self.azure.services.get(service_name)
+        if service is None:
+            raise WindowsAzureMissingResourceError("Not found (Not Found)\nThe hosted service does not exist.")
+        return service
+
+    def _get_deployment(self, service, deployment_name):
+        deployment = service.deployments.get(deployment_name)
+        if deployment is None:
+            raise WindowsAzureMissingResourceError("Not found (Not Found)\nNo deployments were found.")
+        return deployment
+
+    def _get_role(self, deployment, role_name):
+        role = deployment.roles.get(role_name)
+        if role is None:
+            raise WindowsAzureMissingResourceError("Not found (Not Found)\nThe role does not exist.")
+        return role
+
+    def _check_ports(self, deployment, network_config):
+        # Non load-balanced public ports must be unique within a Deployment.
+        used = set()
+        for role in itertools.chain(deployment.roles.values(), deployment.pending):
+            used.update(int(endpoint.port) for endpoint in role.network_config.input_endpoints
+                        if not endpoint.load_balanced_endpoint_set_name)
+        for endpoint in network_config.input_endpoints:
+            if not endpoint.load_balanced_endpoint_set_name and int(endpoint.port) in used:
+                raise WindowsAzureConflictError("Conflict (Conflict)\nPort {0} is already in use.".format(endpoint.port))
+
+    def _new_role(self, service, deployment, role_name, os_virtual_hard_disk, data_virtual_hard_disks, network_config,
+                  role_size):
+        os_disk = _Disk(os_virtual_hard_disk.disk_name or "{0}-{1}-os-{2}".format(service.name, role_name, uuid.uuid4().hex[:6]),
+                        os_virtual_hard_disk.media_link, OS_DISK_SIZE_GB, "Linux", os_virtual_hard_disk.source_image_name)
+        data_disks = []
+        for disk in (data_virtual_hard_disks or []):
+            # Azure names the data Disks itself.
+            name = "{0}-{1}-{2}-{3}".format(service.name, role_name, disk.lun, uuid.uuid4().hex[:6])
+            data_disk = _Disk(name, disk.media_link, int(disk.logical_disk_size_in_gb))
+            data_disk.lun = disk.lun
+            data_disks.append(data_disk)
+
+        role = _Role(role_name, role_size, os_disk, data_disks, network_config)
+        deployment.pending.append(role)
+        return role
+
+    def _role_created(self, service, deployment, role):
+        deployment.pending.remove(role)
+        deployment.roles[role.name] = role
+        for disk in [role.os_disk] + role.data_disks:
+            disk.attached_to = (service.name, deployment.name, role.name)
+            self.azure.disks[disk.name] = disk
+            self.azure.blobs[self.azure.parse_blob_url(disk.media_link)] = _Blob(disk.size_gb * 2 ** 30)
+        self._boot(role)
+
+    def _role_deleted(self, role):
+        detached_at = time.time() + self.azure.duration(self.azure.detach_delay)
+        for disk in [role.os_disk] + role.data_disks:
+            disk.detached_at = detached_at
+        self.azure.ssh.remove(role.name)
+
+    def _boot(self, role):
+        role.status = "Provisioning"
+        role.ready_at = time.time() + self.azure.duration(self.azure.boot_delay)
+        self.azure.ssh.set_ready_at(role.name, role.ready_at)
+
+    def _attached_to(self, disk):
+        if disk.attached_to is None:
+            return None
+        if disk.detached_at is not None and disk.detached_at <= time.time():
+            disk.attached_to = disk.detached_at = None
+            return None
+        attached_to = AttachedTo()
+        attached_to.hosted_service_name, attached_to.deployment_name, attached_to.role_name = disk.attached_to
+        return attached_to
+
+    def _disk(self, disk):
+        result = Disk()
+        result.name = disk.name
+        result.media_link = disk.media_link
+        result.logical_disk_size_in_gb = disk.size_gb
+        result.os = disk.os or u''
+        result.has_operating_system = "true" if disk.os else "false"
+        result.source_image_name = disk.source_image_name or u''
+        result.attached_to = self._attached_to(disk)
+        return result
+
+    def _deployment(self, service, deployment):
+        result = Deployment()
+        result.name = deployment.name
+        result.label = deployment.label
+        result.deployment_slot = "Production"
+        result.status = "Running"
+        result.virtual_network_name = deployment.network_name or u''
+
+        now = time.time()
+        for role in deployment.roles.values():
+            role_result = Role()
+            role_result.role_name = role.name
+            role_result.role_type = "PersistentVMRole"
+            role_result.role_size = role.size
+            role_result.configuration_sets.configuration_sets.append(role.network_config)
+            role_result.os_virtual_hard_disk = OSVirtualHardDisk(
+                source_image_name=role.os_disk.source_image_name, media_link=role.os_disk.media_link,
+                disk_name=role.os_disk.name, os=role.os_disk.os)
+            for disk in role.data_disks:
+                data_disk = DataVirtualHardDisk()
+                data_disk.disk_name, data_disk.media_link = disk.name, disk.media_link
+                data_disk.lun, data_disk.logical_disk_size_in_gb = disk.lun, disk.size_gb
+                role_result.data_virtual_hard_disks.data_virtual_hard_disks.append(data_disk)
+            result.role_list.roles.append(role_result)
+
+            instance = RoleInstance()
+            instance.role_name = instance.instance_name = instance.host_name = role.name
+            instance.instance_size = role.size
+            if role.status == "Provisioning" and role.ready_at <= now:
+                instance.instance_status, instance.power_state = "ReadyRole", "Started"
+            elif role.status == "Provisioning":
+                instance.instance_status, instance.power_state = "Provisioning", "Starting"
+            else:
+                instance.instance_status, instance.power_state = role.status, "Stopped"
+
+            for endpoint in role.network_config.input_endpoints:
+                instance_endpoint = InstanceEndpoint()
+                instance_endpoint.name = endpoint.name
+                instance_endpoint.vip = self.azure.ssh.host
+                instance_endpoint.local_port = str(endpoint.local_port)
+                instance_endpoint.protocol = endpoint.protocol
+                instance_endpoint.public_port = str(endpoint.port)
+                if int(endpoint.local_port) == 22:
+                    # SSH is NAT'ed to the VM's banner listener.
+                    instance_endpoint.public_port = str(self.azure.ssh.port(role.name))
+                instance.instance_endpoints.instance_endpoints.append(instance_endpoint)
+
+            # Public IPs are not reported: they would all need to listen on port 22 locally.
+            result.role_instance_list.role_instances.append(instance)
+
+        return result
+
+
+class FakeBlobService(object):
+
+    def __init__(self, azure, throttle):
+        self.azure = azure
+        self.throttle = throttle
+
+    def _call(self, name):
+        self.azure.call(name, self.throttle)
+
+    def make_blob_url(self, container_name, blob_name, account_name=None, protocol=None, host_base=None):
+        # This one is computed locally by the SDK.
+        return self.azure.blob_url(container_name, blob_name)
+
+    def create_container(self, container_name, x_ms_meta_name_values=None, x_ms_blob_public_access=None,
+                         fail_on_exist=False):
+        self._call("create_container")
+        with self.azure.lock:
+            if container_name in self.azure.containers:
+                if fail_on_exist:
+                    raise WindowsAzureConflictError("Conflict (Conflict)\nThe specified container already exists.")
+                return False
+            self.azure.containers.add(container_name)
+            return True
+
+    def list_blobs(self, container_name, prefix=None, marker=None, maxresults=None, include=None, delimiter=None):
+        self._call("list_blobs")
+        maxresults = maxresults or 5000
+        with self.azure.lock:
+            self._container(container_name)
+            names = sorted(blob_name for c, blob_name in self.azure.blobs
+                           if c == container_name and blob_name.startswith(prefix or ""))
+            if marker:
+                names = [name for name in names if name >= marker]
+
+            results = BlobEnumResults()
+            results.prefix = prefix or u''
+            results.marker = marker or u''
+            results.max_results = maxresults
+            for name in names[:maxresults]:
+                results.blobs.append(self._blob(container_name, name, include))
+            results.next_marker = names[maxresults] if len(names) > maxresults else u''
+            return results
+
+    def get_blob_properties(self, container_name, blob_name, x_ms_lease_id=None):
+        self._call("get_blob_properties")
+        with self.azure.lock:
+            properties = self._blob(container_name, blob_name, "copy").properties
+            headers = {
+                "content-length": str(properties.content_length),
+                "x-ms-blob-type": properties.blob_type,
+                "x-ms-lease-state": properties.lease_state,
+            }
+            for name, value in self._blob_state(container_name, blob_name).metadata.items():
+                headers["x-ms-meta-" + name] = value
+            if properties.copy_status:
+                headers.update({
+                    "x-ms-copy-id": properties.copy_id,
+                    "x-ms-copy-status": properties.copy_status,
+                    "x-ms-copy-progress": properties.copy_progress,
+                })
+            return headers
+
+    def copy_blob(self, container_name, blob_name, x_ms_copy_source, **kwargs):
+        self._call("copy_blob")
+        with self.azure.lock:
+            self._container(container_name)
+            source = self.azure.blobs.get(self.azure.parse_blob_url(x_ms_copy_source))
+            if source is None:
+                raise WindowsAzureMissingResourceError("Not found (Not Found)\nThe specified blob does not exist.")
+
+            blob = _Blob(source.size, source.blob_type)
+            blob.copy_id = uuid.uuid4().hex
+            blob.copy_source = x_ms_copy_source
+            blob.copy_done_at = time.time() + source.size * self.azure.time_scale / self.azure.copy_throughput
+            self.azure.blobs[(container_name, blob_name)] = blob
+            return {"x-ms-copy-id": blob.copy_id, "x-ms-copy-status": "pending"}
+
+    def put_blob(self, container_name, blob_name, blob, x_ms_blob_type, x_ms_blob_content_length=None,
+                 x_ms_meta_name_values=None, **kwargs):
+        self._call("put_blob")
+        if x_ms_blob_type != "PageBlob" or blob is not None:
+            raise NotImplementedError("Only empty page blobs can be created")
+        size = int(x_ms_blob_content_length)
+        if size % 512:
+            raise WindowsAzureError("Unknown error (Bad Request)\nThe page blob size must be aligned to 512 bytes.")
+        with self.azure.lock:
+            self._container(container_name)
+            if self._leased(container_name, blob_name):
+                raise WindowsAzureConflictError("Conflict (Conflict)\nThere is currently a lease on the blob.")
+            self.azure.blobs[(container_name, blob_name)] = _Blob(size)
+            self.azure.blobs[(container_name, blob_name)].metadata = dict(x_ms_meta_name_values or {})
+
+    def put_page(self, container_name, blob_name, page, x_ms_range, x_ms_page_write, **kwargs):
+        self._call("put_page")
+        start, end = [int(offset) for offset in x_ms_range[len("bytes="):].split("-")]
+        end += 1
+        if x_ms_page_write != "update" or start % 512 or end % 512 or len(page) != end - start:
+            raise WindowsAzureError("Unknown error (Bad Request)\nThe range specified is invalid.")
+        if len(page) > 4 * 2 ** 20:
+            raise WindowsAzureError("Unknown error (Request Entity Too Large)\nThe request body is too large.")
+        with self.azure.lock:
+            blob = self._blob_state(container_name, blob_name)
+            if end > blob.size:
+                raise WindowsAzureError("Unknown error (Requested Range Not Satisfiable)")
+        # The upload itself is what takes time.
+        time.sleep(float(len(page)) / self.azure.upload_throughput * self.azure.time_scale)
+        with self.azure.lock:
+            self._blob_state(container_name, blob_name).write_pages(start, end)
+
+    def get_page_ranges(self, container_name, blob_name, **kwargs):
+        self._call("get_page_ranges")
+        with self.azure.lock:
+            blob = self._blob_state(container_name, blob_name)
+            result = PageList()
+            for start, end in blob.pages:
+                page_range = PageRange()
+                page_range.start, page_range.end = start, end - 1
+                result.page_ranges.append(page_range)
+            return result
+
+    def delete_blob(self, container_name, blob_name, snapshot=None, x_ms_lease_id=None):
+        self._call("delete_blob")
+        with self.azure.lock:
+            self._blob(container_name, blob_name)
+            if self._leased(container_name, blob_name):
+                raise WindowsAzureConflictError("Conflict (Conflict)\nThere is currently a lease on the blob.")
+            del self.azure.blobs[(container_name, blob_name)]
+
+    def _container(self, container_name):
+        if container_name not in self.azure.containers:
+            raise WindowsAzureMissingResourceError("Not found (Not Found)\nThe specified container does not exist.")
+
+    def _leased(self, container_name, blob_name):
+        # Azure holds a lease on the VHDs of the Disks that are attached to a VM.
+        url = self.azure.blob_url(container_name, blob_name)
+        return any(disk.media_link == url and self.azure.sms._attached_to(disk) is not None
+                   for disk in self.azure.disks.values())
+
+    def _blob_state(self, container_name, blob_name):
+        blob = self.azure.blobs.get((container_name, blob_name))
+        if blob is None:
+            raise WindowsAzureMissingResourceError("Not found (Not Found)\nThe specified blob does not exist.")
+        return blob
+
+    def _blob(self, container_name, blob_name, include=None):
+        blob = self._blob_state(container_name, blob_name)
+
+        result = Blob()
+        result.name = blob_name
+        result.url = self.azure.blob_url(container_name, blob_name)
+        properties = result.properties
+        properties.content_length = blob.size
+        properties.blob_type = blob.blob_type
+        # Completing a copy counts as a write.
+        properties.last_modified = email.utils.formatdate(max(blob.modified_at, blob.copy_done_at or 0), usegmt=True)
+        leased = self._leased(container_name, blob_name)
+        properties.lease_status = "locked" if leased else "unlocked"
+        properties.lease_state = "leased" if leased else "available"
+        if blob.copy_id is not None and include and "copy" in include:
+            pending = blob.copy_pending()
+            properties.copy_id = blob.copy_id
+            properties.copy_source = blob.copy_source
+            properties.copy_status = "pending" if pending else "success"
+            if pending:
+                # The copy progresses linearly.
+                remaining = (blob.copy_done_at - time.time()) / self.azure.time_scale * self.azure.copy_throughput
+                properties.copy_progress = "{0}/{1}".format(max(0, int(blob.size - remaining)), blob.size)
+            else:
+                properties.copy_progress = "{0}/{0}".format(blob.size)
+        return result
+
+
+class SSHBannerListener(object):
+    """
+    Listens on one local port per VM, and answers connections with an SSH banner once the VM has booted (connections
+    made before that are closed right away, which is what SSHProber sees while sshd isn't up yet).
+    """
+
+    def __init__(self, host="127.0.0.1"):
+        self.host = host
+        self._lock = threading.Lock()
+        self._sockets = {}  # role name -> listening socket
+        self._ready_at = {}  # role name -> when the VM answers, or None if it doesn't
+        self._names = {}  # listening socket -> role name
+        self._removed = []  # Sockets to close (the select loop might still be waiting on them)
+        self.first_banner_at = {}  # role name -> when an SSH banner was first served
+        self._thread = None
+        self._closed = False
+        # Wakes up the select loop when sockets are added or removed.
+        self._wake_r, self._wake_w = socket.socketpair()
+
+    def port(self, name):
+        with self._lock:
+            if name not in self._sockets:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.bind((self.host, 0))
+                sock.listen(128)
+                sock.setblocking(0)
+                self._sockets[name] = sock
+                self._names[sock] = name
+                self._ready_at.setdefault(name, None)
+                self._start()
+            return self._sockets[name].getsockname()[1]
+
+    def set_ready_at(self, name, ready_at):
+        self.port(name)
+        with self._lock:
+            self._ready_at[name] = ready_at
+
+    def remove(self, name):
+        with self._lock:
+            sock = self._sockets.pop(name, None)
+            self._ready_at.pop(name, None)
+            if sock is not None:
+                del self._names[sock]
+                self._removed.append(sock)
+        self._wake()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._removed.extend(self._sockets.values())
+            self._sockets.clear()
+            self._names.clear()
+            thread = self._thread
+        if thread is None:
+            for sock in self._removed:
+                sock.close()
+            self._wake_r.close()
+            self._wake_w.close()
+        else:
+            self._wake()
+            thread.join()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ssh-banner-listener")
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"x")
+        except socket.error:
+            pass
+
+    def _run(self):
+        while 1:
+            with self._lock:
+                for sock in self._removed:
+                    sock.close()
+                del self._removed[:]
+                if self._closed:
+                    self._wake_r.close()
+                    self._wake_w.close()
+                    return
+                listening = list(self._names)
+
+            readable, _, _ = select.select(listening + [self._wake_r], [], [])
+
+            for sock in readable:
+                if sock is self._wake_r:
+                    sock.recv(4096)
+                    continue
+                with self._lock:
+                    name = self._names.get(sock)
+                    ready_at = self._ready_at.get(name)
+                    if name is None:
+                        continue  # Removed in the meantime
+                    try:
+                        conn, _ = sock.accept()
+                    except socket.error as e:
+                        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            continue
+                        raise
+                try:
+                    now = time.time()
+                    if ready_at is not None and ready_at <= now:
+                        conn.sendall(SSH_BANNER)
+                        with self._lock:
+                            self.first_banner_at.setdefault(name, now)
+                finally:
+                    conn.close()
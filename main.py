@@ -1,14 +1,41 @@
 #coding:utf-8
 import argparse
 import base64
+import bisect
+import collections
+import contextlib
+import email.utils
+import errno
+import fcntl
+import hashlib
+import heapq
+import httplib
+import itertools
+import json
+import math
+import mmap
+import os
+import select
 import socket
+import string
+import subprocess
 import logging
 import random
+import re
+import sys
+import threading
 import uuid
 import time
+import urllib
+import urlparse
+import Queue
 
+import requests
 from attrdict import load as attrdict_load
-from azure import WindowsAzureMissingResourceError
+from concurrent.futures import Future, ThreadPoolExecutor
+from azure import WindowsAzureError, WindowsAzureConflictError, WindowsAzureMissingResourceError
+from azure.http import HTTPError
+from azure.http.httpclient import _HTTPClient
 from azure.servicemanagement import ServiceManagementService, ConfigurationSet, ConfigurationSetInputEndpoint, PublicIP, \
     OSVirtualHardDisk, DataVirtualHardDisks, DataVirtualHardDisk, LinuxConfigurationSet
 from azure.storage import BlobService
@@ -18,22 +45,241 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-# noinspection PyUnusedLocal
-def ssh_up(name, host, port, timeout=5):
-    try:
-        s = socket.create_connection((host, port), timeout)
-        s.settimeout(timeout)
-        data = s.recv(64).strip()
-    except (socket.error, socket.timeout) as e:
-        logger.debug("SSH connection failed with: %s", e)
-        return False
-
-    if not data.startswith('SSH'):
-        logger.warning("SSH did not respond with 'SSH' header: '%s'", data)
-        return False
-
-    logger.debug("SSH responded with 'SSH' header: '%s'", data)
-    return True
+class Tracer(object):
+    """
+    Records timed spans (API calls, operation polls, SSH attempts, waits), so that we can tell where a run spends its
+    time. Spans can be exported in the Chrome trace format (open them in chrome://tracing or https://ui.perfetto.dev),
+    and summarized per phase of the run.
+
+    Tracing is off until `enable` is called, and spans cost next to nothing until then.
+    """
+
+    # The categories of spans, in the order they're summarized.
+    CATEGORIES = ("api", "poll", "ssh", "wait", "backoff")
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._origin = time.time()
+        self._spans = []  # (category, name, start, end, thread name, args)
+        self._phases = []  # (name, start, end)
+
+    def enable(self):
+        with self._lock:
+            self._spans = []
+            self._phases = []
+        self._origin = time.time()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @contextlib.contextmanager
+    def span(self, category, name, **args):
+        # Yields the span's args, so that more can be added once the outcome is known.
+        if not self.enabled:
+            yield {}
+            return
+        started_at = time.time()
+        try:
+            yield args
+        except Exception as e:
+            args["error"] = str(e).split("\n")[0]
+            raise
+        finally:
+            self.record(category, name, started_at, time.time(), **args)
+
+    def record(self, category, name, started_at, ended_at, **args):
+        if self.enabled:
+            with self._lock:
+                self._spans.append((category, name, started_at, ended_at, threading.current_thread().name, args))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                with self._lock:
+                    self._phases.append((name, started_at, time.time()))
+
+    def export(self, path):
+        with self._lock:
+            spans = list(self._spans)
+            phases = list(self._phases)
+
+        def to_us(t):
+            return int((t - self._origin) * 1e6)
+
+        events = []
+        thread_ids = {"phases": 0}
+        for name, started_at, ended_at in phases:
+            events.append({"name": name, "cat": "phase", "ph": "X", "pid": 1, "tid": 0, "ts": to_us(started_at),
+                           "dur": to_us(ended_at) - to_us(started_at)})
+        for category, name, started_at, ended_at, thread_name, args in spans:
+            thread_id = thread_ids.setdefault(thread_name, len(thread_ids))
+            events.append({"name": name, "cat": category, "ph": "X", "pid": 1, "tid": thread_id, "ts": to_us(started_at),
+                           "dur": to_us(ended_at) - to_us(started_at), "args": args})
+        for thread_name, thread_id in thread_ids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": thread_id, "args": {"name": thread_name}})
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logger.info("Wrote %s spans to '%s'", len(spans), path)
+
+    def log_summary(self):
+        """
+        Log how many spans of each category each phase had, and how long they took in total (spans overlap when
+        they're in different threads, so the totals can exceed the phase's duration).
+        """
+        with self._lock:
+            spans = list(self._spans)
+            phases = list(self._phases)
+        if not spans:
+            return
+        phases.append(("total", self._origin, max(ended_at for _, _, _, ended_at, _, _ in spans)))
+
+        logger.info("%-10s %10s" + " %16s" * len(self.CATEGORIES), "phase", "duration", *self.CATEGORIES)
+        for name, phase_started_at, phase_ended_at in phases:
+            count = collections.Counter()
+            total = collections.Counter()
+            for category, _, started_at, ended_at, _, _ in spans:
+                if phase_started_at <= started_at < phase_ended_at:
+                    count[category] += 1
+                    total[category] += ended_at - started_at
+            logger.info("%-10s %9.1fs" + " %16s" * len(self.CATEGORIES), name, phase_ended_at - phase_started_at,
+                        *["{0} / {1:.1f}s".format(count[category], total[category]) for category in self.CATEGORIES])
+
+
+tracer = Tracer()
+
+
+def _span_args(args, kwargs):
+    # Tag API call spans with what they're about (Hosted Service, Deployment, VM, Disk, container, blob...).
+    tags = dict((key, value) for key, value in kwargs.items() if key.endswith("_name") and isinstance(value, basestring))
+    # Long strings are request bodies (e.g. pages of a blob), not names.
+    positional = [arg for arg in args if isinstance(arg, basestring) and len(arg) <= 1024]
+    if positional:
+        tags["args"] = positional
+    return tags
+
+
+class SSHProber(object):
+    """
+    Checks for an SSH banner on many targets at once, using non-blocking sockets.
+
+    Targets are (name, host, port) tuples, and several targets can share a name (e.g. a VM with a NAT endpoint and a
+    Public IP). A target that doesn't answer is retried with an exponential backoff of its own, so that one dead VM
+    doesn't hold up the others. A name is considered up once all of its targets have answered.
+    """
+
+    def __init__(self, concurrency=64, timeout=5, initial_backoff=1, max_backoff=30):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+    def probe(self, targets):
+        """
+        Probe the targets until they're all up. Returns a dict mapping each name to the number of seconds it took for
+        all its targets to respond.
+        """
+        started_at = time.time()
+        targets_left = collections.Counter(name for name, _, _ in targets)
+        time_to_ssh = {}
+
+        pending = [(started_at, target, self.initial_backoff) for target in targets]  # A heap of retries
+        heapq.heapify(pending)
+        connecting = {}  # socket -> (target, backoff, deadline)
+        reading = {}  # socket -> (target, backoff, deadline)
+
+        while pending or connecting or reading:
+            now = time.time()
+
+            while pending and pending[0][0] <= now and len(connecting) + len(reading) < self.concurrency:
+                _, target, backoff = heapq.heappop(pending)
+                logger.debug("Trying to hit SSH on %s at %s:%s", *target)
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                err = sock.connect_ex(target[1:])
+                if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    connecting[sock] = (target, backoff, now + self.timeout)
+                else:
+                    logger.debug("SSH connection failed with: %s", os.strerror(err))
+                    sock.close()
+                    self._attempted(target, now, os.strerror(err))
+                    self._retry(pending, target, backoff)
+
+            # Figure out how long we can afford to wait for sockets to become ready.
+            wake_up_at = [deadline for _, _, deadline in itertools.chain(connecting.values(), reading.values())]
+            if pending and len(connecting) + len(reading) < self.concurrency:
+                wake_up_at.append(pending[0][0])
+            if not wake_up_at:
+                continue
+            wait = max(0, min(wake_up_at) - time.time())
+
+            readable, writable, _ = select.select(list(reading), list(connecting), [], wait)
+
+            for sock in writable:
+                target, backoff, deadline = connecting.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    logger.debug("SSH connection failed with: %s", os.strerror(err))
+                    sock.close()
+                    self._attempted(target, deadline - self.timeout, os.strerror(err))
+                    self._retry(pending, target, backoff)
+                else:
+                    reading[sock] = (target, backoff, deadline)
+
+            for sock in readable:
+                target, backoff, deadline = reading.pop(sock)
+                try:
+                    data = sock.recv(64).strip()
+                except socket.error as e:
+                    logger.debug("SSH connection failed with: %s", e)
+                    data = None
+                sock.close()
+
+                if not data or not data.startswith(b'SSH'):
+                    if data:
+                        logger.warning("SSH did not respond with 'SSH' header: '%s'", data)
+                    self._attempted(target, deadline - self.timeout, "no banner")
+                    self._retry(pending, target, backoff)
+                    continue
+
+                logger.info("SSH is up on %s at %s:%s", *target)
+                self._attempted(target, deadline - self.timeout, "up")
+                name = target[0]
+                targets_left[name] -= 1
+                if not targets_left[name]:
+                    time_to_ssh[name] = time.time() - started_at
+
+            now = time.time()
+            for sockets in (connecting, reading):
+                for sock, (target, backoff, deadline) in list(sockets.items()):
+                    if deadline <= now:
+                        logger.debug("SSH connection to %s at %s:%s timed out", *target)
+                        del sockets[sock]
+                        sock.close()
+                        self._attempted(target, deadline - self.timeout, "timed out")
+                        self._retry(pending, target, backoff)
+
+        return time_to_ssh
+
+    def _attempted(self, target, started_at, outcome):
+        name, host, port = target
+        tracer.record("ssh", name, started_at, time.time(), host=host, port=port, outcome=outcome)
+
+    def _retry(self, pending, target, backoff):
+        logger.info("SSH is not up on %s at %s:%s", *target)
+        heapq.heappush(pending, (time.time() + backoff, target, min(backoff * 2, self.max_backoff)))
+
+
+def percentile(values, p):
+    # Nearest-rank percentile
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
 
 
 class OperationFailed(Exception):
@@ -45,28 +291,1002 @@ class OperationFailed(Exception):
         return "{0} ({1})".format(self.code, self.message)
 
 
-def wait_for_operation(sms, operation):
-
+class _Poller(object):
+    """
+    Polls for the state of many things from a thread of its own, which is started once there's something to poll.
+    Subclasses implement `_run`, which must return once the poller is closed.
+    """
+
+    def __init__(self, thread_name):
+        self._thread_name = thread_name
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        # Let the thread wind down before we return (daemon threads that outlive the interpreter die noisily).
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _start(self):
+        # Must be called with the condition held, before adding something to poll.
+        if self._closed:
+            raise RuntimeError("{0} is closed".format(type(self).__name__))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self._thread_name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        raise NotImplementedError()
+
+
+class OperationTracker(_Poller):
+    """
+    Tracks many in-flight asynchronous operations, and polls all of them from a single scheduler thread.
+
+    Each operation is polled on its own schedule: quickly at first (plenty of operations complete in a few seconds),
+    and less and less often as it drags on (provisioning a VM takes minutes). Callers get a Future for each operation
+    they track, so that several operations can be waited on at once, instead of one after the other.
+    """
+
+    def __init__(self, sms, initial_interval=0.5, max_interval=10, backoff=1.5):
+        super(OperationTracker, self).__init__("operation-tracker")
+        self.sms = sms
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+        self._schedule = []  # A heap of (next poll time, sequence number, request_id, interval, future)
+        self._sequence = itertools.count()
+        self._listeners = []
+        self._labels = {}  # request_id -> label
+
+    def add_listener(self, listener):
+        """
+        Register a function to be called with the request ID of every operation that completes (successfully or not).
+        Listeners are called before the operation's Future is resolved.
+        """
+        self._listeners.append(listener)
+
+    def track(self, operation, callback=None, label=None):
+        """
+        Start tracking an operation (or a request ID). The returned Future resolves to the final operation status, or
+        fails with OperationFailed. If a callback is passed, it's called with the Future once it's done. The label
+        (e.g. the name of the VM the operation is about) names the operation's polls in traces.
+        """
+        request_id = getattr(operation, "request_id", operation)
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        with self._cond:
+            self._start()
+            self._labels[request_id] = label or request_id
+            self._push(time.time(), request_id, self.initial_interval, future)
+            self._cond.notify()
+
+        return future
+
+    def _push(self, when, request_id, interval, future):
+        heapq.heappush(self._schedule, (when, next(self._sequence), request_id, interval, future))
+
+    def _run(self):
+        while 1:
+            with self._cond:
+                while not self._closed:
+                    if not self._schedule:
+                        self._cond.wait()
+                        continue
+                    delay = self._schedule[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+
+                if self._closed:
+                    for _, _, _, _, future in self._schedule:
+                        future.cancel()
+                    return
+
+                now = time.time()
+                due = []
+                while self._schedule and self._schedule[0][0] <= now:
+                    due.append(heapq.heappop(self._schedule))
+
+            # We don't hold the lock while polling, so that new operations can be tracked in the meantime.
+            for _, _, request_id, interval, future in due:
+                if not self._poll(request_id, future):
+                    interval = min(interval * self.backoff, self.max_interval)
+                    with self._cond:
+                        self._push(time.time() + interval, request_id, interval, future)
+
+    def _poll(self, request_id, future):
+        # Returns whether the operation is done (i.e. whether we resolved the future).
+        try:
+            with tracer.span("poll", self._labels[request_id], request_id=request_id) as tags:
+                status = self.sms.get_operation_status(request_id)
+                tags["status"] = status.status
+        except Exception as e:
+            logger.error("Failed to retrieve status for operation '%s': %s", request_id, e)
+            self._done(request_id)
+            future.set_exception(e)
+            return True
+
+        logger.debug("Operation '%s' status is '%s'", request_id, status.status)
+        if status.status == "InProgress":
+            return False
+
+        self._done(request_id)
+
+        if status.error is not None:
+            logger.error("Request failed: %s (%s)", status.error.code, status.error.message)
+            future.set_exception(OperationFailed(status.error.code, status.error.message))
+        else:
+            logger.info("Operation '%s' completed with '%s'", request_id, status.status)
+            future.set_result(status)
+        return True
+
+    def _done(self, request_id):
+        with self._cond:
+            del self._labels[request_id]
+        self._notify(request_id)
+
+    def _notify(self, request_id):
+        for listener in self._listeners:
+            try:
+                listener(request_id)
+            except Exception:
+                logger.exception("Operation listener failed for '%s'", request_id)
+
+
+class Journal(object):
+    """
+    An on-disk record of the operations we issue (along with what they're about: VMs, Disks, blobs), and of whether
+    they completed. If a run dies midway, the next run with the same journal reattaches to the operations that were
+    still in flight instead of issuing them again, and skips the steps that were already done.
+
+    Each step is identified by a kind (e.g. "deploy") and a key (e.g. the VM's name). The journal is a file of JSON
+    lines, each of which updates the fields of a step. Only an open journal records or remembers steps: the steps of
+    one run (e.g. a daemon command) must not leak into the next.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._lock = threading.Lock()
+        self._steps = collections.OrderedDict()  # (kind, key) -> fields
+        self._file = None
+
+    def open(self, path):
+        with self._lock:
+            self._steps.clear()
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        update = json.loads(line)
+                    except ValueError:
+                        # The last line may have been cut short by the crash.
+                        logger.warning("Ignoring truncated journal entry: %r", line)
+                        continue
+                    self._steps.setdefault((update["kind"], update["key"]), {}).update(update)
+            logger.info("Resuming from journal '%s' (%s steps)", path, len(self._steps))
+        self._file = open(path, "a")
+
+    def close(self, completed=False):
+        """
+        Close the journal. Once the run has completed, there's nothing left to resume, so the journal is deleted.
+        """
+        with self._lock:
+            self._steps.clear()
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if completed:
+            os.remove(self.path)
+        self.path = None
+
+    def record(self, kind, key, **fields):
+        if self._file is None:
+            return
+        update = dict(fields, kind=kind, key=key)
+        with self._lock:
+            self._steps.setdefault((kind, key), {}).update(update)
+            self._file.write(json.dumps(update) + "\n")
+            # The whole point is to survive a crash.
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def get(self, kind, key):
+        with self._lock:
+            step = self._steps.get((kind, key))
+            return dict(step) if step is not None else None
+
+    def steps(self, kind=None, **fields):
+        """
+        Returns the steps of the given kind (or of any kind) whose fields match.
+        """
+        with self._lock:
+            return [dict(step) for (step_kind, _), step in self._steps.items()
+                    if kind in (None, step_kind) and all(step.get(name) == value for name, value in fields.items())]
+
+    def track(self, tracker, kind, key, operation, callback=None, **fields):
+        """
+        Record an operation we just issued, and track it (recording its outcome). Returns the tracker's Future.
+        """
+        self.record(kind, key, request_id=operation.request_id, state="issued", **fields)
+        return self.reattach(tracker, kind, key, operation.request_id, callback)
+
+    def reattach(self, tracker, kind, key, request_id, callback=None):
+        future = tracker.track(request_id, callback, label=key)
+
+        def on_done(future):
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is None:
+                self.record(kind, key, state="succeeded")
+            elif isinstance(error, OperationFailed):
+                self.record(kind, key, state="failed", error=str(error))
+            # Otherwise, we couldn't poll the operation, and we don't know how it went.
+
+        future.add_done_callback(on_done)
+        return future
+
+    def resume(self, tracker, kind, key):
+        """
+        Returns a Future for a step that a previous run issued (already resolved if the step completed), or None if
+        the step is still to be done.
+        """
+        step = self.get(kind, key)
+        if step is None or step["state"] not in ("issued", "succeeded"):
+            return None
+        if step["state"] == "succeeded":
+            logger.info("Skipping '%s' for '%s': it was done by a previous run", kind, key)
+            future = Future()
+            future.set_result(None)
+            return future
+        logger.info("Reattaching to '%s' for '%s' (operation '%s')", kind, key, step["request_id"])
+        return self.reattach(tracker, kind, key, step["request_id"])
+
+
+journal = Journal()
+
+
+CopyStats = collections.namedtuple("CopyStats", ["blob_name", "size", "duration"])
+
+
+def iter_blobs(bs, container_name, prefix=None, include=None):
+    """
+    Yields the blobs in a container, one page of the listing at a time: a container with thousands of blobs doesn't
+    have to be listed in full before we get to work on it.
+    """
+    marker = None
     while 1:
-        status = sms.get_operation_status(operation.request_id)
-        logger.debug("Operation status is '%s'", status.status)
-        if status.status != "InProgress":
-            break
-        time.sleep(1)
+        blobs = bs.list_blobs(container_name, prefix=prefix, marker=marker, include=include)
+        for blob in blobs:
+            yield blob
+        marker = blobs.next_marker
+        if not marker:
+            return
+
+
+class BlobCopyWatcher(_Poller):
+    """
+    Starts server-side copies of blobs into a container, and tracks them until they complete.
+
+    The status of all the copies in flight is refreshed with a single listing of the container per poll interval,
+    rather than with one request per blob. A copy whose blob is missing from `max_missing` listings in a row (e.g.
+    because it was deleted, or isn't under `prefix`) fails.
+    """
+
+    def __init__(self, bs, container_name, prefix=None, poll_interval=5, max_missing=3):
+        super(BlobCopyWatcher, self).__init__("blob-copy-watcher")
+        self.bs = bs
+        self.container_name = container_name
+        self.prefix = prefix
+        self.poll_interval = poll_interval
+        self.max_missing = max_missing
+
+        self._pending = {}  # blob name -> (future, start time)
+
+    def copy(self, blob_name, source_url):
+        """
+        Start copying `source_url` to `blob_name`. The returned Future resolves to CopyStats once the copy has
+        completed, or fails with OperationFailed.
+        """
+        future = Future()
+        started_at = time.time()
+        result = self.bs.copy_blob(self.container_name, blob_name, source_url)
+
+        # Copies within a Storage Account are often complete by the time copy_blob returns.
+        if result.get("x-ms-copy-status") == "success":
+            self._complete(future, blob_name, started_at, None)
+            return future
+
+        self._watch(blob_name, future, started_at)
+        return future
+
+    def watch(self, blob_name):
+        """
+        Track a copy to `blob_name` that was started earlier (e.g. by a previous run). The returned Future is the same
+        as for `copy`.
+        """
+        future = Future()
+        self._watch(blob_name, future, time.time())
+        return future
+
+    def _watch(self, blob_name, future, started_at):
+        with self._cond:
+            self._start()
+            self._pending[blob_name] = (future, started_at)
+            self._cond.notify()
+
+    def _run(self):
+        missing = collections.Counter()  # blob name -> number of listings in a row it was missing from
+        while 1:
+            with self._cond:
+                while not self._closed and not self._pending:
+                    self._cond.wait()
+                if self._closed:
+                    for future, _ in self._pending.values():
+                        future.cancel()
+                    return
+                pending = dict(self._pending)
+
+            try:
+                statuses = self._list()
+            except Exception as e:
+                logger.warning("Failed to list blobs in '%s': %s", self.container_name, e)
+                # We can't tell how the copies are doing this time around.
+                statuses, pending = {}, {}
+
+            for blob_name, (future, started_at) in pending.items():
+                properties = statuses.get(blob_name)
+                if properties is None:
+                    missing[blob_name] += 1
+                    if missing[blob_name] < self.max_missing:
+                        continue
+                elif properties.copy_status == "pending":
+                    missing.pop(blob_name, None)
+                    logger.debug("Copy to '%s' is in progress (%s bytes)", blob_name, properties.copy_progress)
+                    continue
+
+                missing.pop(blob_name, None)
+                with self._cond:
+                    del self._pending[blob_name]
+
+                if properties is None:
+                    logger.error("Copy to '%s' failed: the blob is missing from '%s'", blob_name, self.container_name)
+                    future.set_exception(OperationFailed("BlobNotFound", "The blob '{0}' is missing from '{1}'".format(
+                        blob_name, self.container_name)))
+                elif properties.copy_status == "success":
+                    self._complete(future, blob_name, started_at, properties)
+                else:
+                    logger.error("Copy to '%s' failed: %s (%s)", blob_name, properties.copy_status,
+                                 properties.copy_status_description)
+                    future.set_exception(OperationFailed(properties.copy_status, properties.copy_status_description))
+
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.poll_interval)
+
+    def _list(self):
+        return dict((blob.name, blob.properties)
+                    for blob in iter_blobs(self.bs, self.container_name, prefix=self.prefix, include="copy"))
+
+    def _complete(self, future, blob_name, started_at, properties):
+        duration = time.time() - started_at
+        if properties is None:
+            properties = self.bs.get_blob_properties(self.container_name, blob_name)
+            size = int(properties["content-length"])
+        else:
+            size = int(properties.content_length)
+        logger.info("Copied '%s' (%.1f GB) in %.0fs (%.1f MB/s)", blob_name, size / 2.0 ** 30, duration,
+                    size / 2.0 ** 20 / max(duration, 1e-3))
+        future.set_result(CopyStats(blob_name, size, duration))
+
+
+def chain(source, target, transform=None):
+    """
+    Resolve the `target` Future with the outcome of the `source` Future (optionally transforming its result).
+    """
+    def on_done(future):
+        if future.cancelled():
+            target.cancel()
+        elif future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result() if transform is None else transform(future.result()))
+    source.add_done_callback(on_done)
+
+
+def wait_for_all(futures):
+    # Wait on all the futures before raising, so that we don't abandon operations that are still running.
+    errors = []
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def _per_thread(name):
+    def getter(self):
+        return getattr(self._per_thread_state, name, None)
+
+    def setter(self, value):
+        setattr(self._per_thread_state, name, value)
+
+    return property(getter, setter)
+
+
+class _ThreadSafeHTTPClient(_HTTPClient):
+    # _HTTPClient records the status of the response it is processing on the instance (and then checks it to decide
+    # whether to raise), so two threads sharing a service object can trip over each other. We keep that state
+    # per-thread instead.
+    _per_thread_state = threading.local()
+
+    status = _per_thread("status")
+    message = _per_thread("message")
+    respheader = _per_thread("respheader")
+
+    def perform_request(self, request):
+        try:
+            return super(_ThreadSafeHTTPClient, self).perform_request(request)
+        except HTTPError as e:
+            raise keep_conflict_body(e)
+
+
+def keep_conflict_body(http_error):
+    """
+    The SDK turns a 409 into a WindowsAzureConflictError that only says "Conflict (Conflict)", and drops the body of
+    the response: that's where Azure tells us why (e.g. which operation holds a busy Deployment, see `busy_with`). This
+    returns an HTTPError whose message includes the body.
+    """
+    if http_error.status != 409 or not http_error.respbody:
+        return http_error
+    message = "{0}\n{1}".format(http_error, http_error.respbody.decode("utf-8-sig"))
+    return HTTPError(http_error.status, message, http_error.respheader, http_error.respbody)
+
+
+def make_thread_safe(service):
+    # Both ServiceManagementService and BlobService use an _HTTPClient under the hood. ServiceManagementService
+    # holds on to the client's `perform_request` method, which we have to swap too.
+    service._httpclient.__class__ = _ThreadSafeHTTPClient
+    if isinstance(service, ServiceManagementService):
+        service._filter = service._httpclient.perform_request
+    return service
+
+
+def make_session(pool_size=32, cert=None):
+    """
+    By default, the SDK opens a new connection (and goes through a TLS handshake) for every single request. A requests
+    Session keeps up to `pool_size` connections alive instead, and shares them among all the threads making requests
+    (when they're all in use, the next request waits for one rather than opening a connection that would be thrown
+    away).
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # The Service Management API authenticates us with a client certificate.
+    session.cert = cert
+    return session
+
+
+def use_session(service, session):
+    # ServiceManagementService takes a `request_session`, but BlobService doesn't: its _HTTPClient does, though.
+    service._httpclient.request_session = session
+    service._httpclient.use_httplib = True
+    return service
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per second on average, with bursts of up to `burst` requests.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated_at = time.time()
+
+    def acquire(self):
+        while 1:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            with tracer.span("wait", "rate limit"):
+                time.sleep(wait)
 
-    # noinspection PyUnboundLocalVariable
-    if status.error is not None:
-        logger.error("Request failed: %s (%s)", status.error.code, status.error.message)
-        raise OperationFailed(status.error.code, status.error.message)
 
-    logger.info("Operation '%s' completed with '%s'", operation.request_id, status.status)
+# Transient errors only show up in the error message (the SDK raises a plain WindowsAzureError for those). Throttled
+# requests were turned away, whereas the others may have been carried out all the same.
+_THROTTLED_ERROR_MARKERS = ("(Service Unavailable)", "(Too Many Requests)", "TooManyRequests", "ServerBusy")
+_TRANSIENT_ERROR_MARKERS = _THROTTLED_ERROR_MARKERS + ("(Internal Server Error)", "(Bad Gateway)", "(Gateway Timeout)",
+                                                       "OperationTimedOut")
+
+
+# With a requests Session (see `make_session`), network errors surface as requests exceptions instead. Keep-alive
+# connections that the server closed while they were idle show up as ConnectionErrors too.
+_TRANSPORT_ERRORS = (socket.error, httplib.HTTPException, requests.exceptions.ConnectionError,
+                     requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+def is_transient(error):
+    if isinstance(error, _TRANSPORT_ERRORS):
+        return True
+    return _has_marker(error, _TRANSIENT_ERROR_MARKERS)
+
+
+def is_throttled(error):
+    return _has_marker(error, _THROTTLED_ERROR_MARKERS)
+
+
+def _has_marker(error, markers):
+    if isinstance(error, (WindowsAzureMissingResourceError, WindowsAzureConflictError)):
+        return False
+    if isinstance(error, WindowsAzureError):
+        return any(marker in str(error) for marker in markers)
+    return False
+
+
+# Azure uses Conflict for "this already exists" too, but when a Deployment is busy, it tells us with which operation
+# (provided we kept the body of the response, see `keep_conflict_body`).
+_BUSY_DEPLOYMENT_RE = re.compile(r"performing an operation with x-ms-requestid (\w+)")
+
+
+def busy_with(error):
+    """
+    Returns the request ID of the operation that holds the Deployment if `error` is a Conflict because of it (or None).
+    """
+    if not isinstance(error, WindowsAzureConflictError):
+        return None
+    match = _BUSY_DEPLOYMENT_RE.search(str(error))
+    return match.group(1) if match is not None else None
+
+
+class RequestScheduler(object):
+    """
+    All the requests to a given API (i.e. a Subscription's Service Management API, or a Storage Account) should go
+    through a single scheduler, which:
+
+      + Rate-limits requests with a token bucket.
+      + Retries throttled requests and transient errors, with a jittered exponential backoff. A request that failed
+        along the way may have been carried out all the same, so only reads (and writes that can safely be made twice)
+        are retried then.
+      + Serializes operations on a given Deployment: Azure rejects an operation on a Deployment while another one is in
+        progress, so the next one is held back until the previous one completes (the `operation_completed` method
+        should be registered as a listener on the OperationTracker).
+      + Waits out the operations that others (e.g. another invocation) are running on a Deployment: if a `tracker` is
+        set, the operation that holds the Deployment is tracked until it completes, before the request is made again.
+        This goes on for up to `busy_timeout` seconds.
+    """
+
+    # These methods start an asynchronous operation on the Deployment identified by their first two arguments.
+    DEPLOYMENT_OPERATIONS = ("create_virtual_machine_deployment", "add_role", "delete_role", "start_roles",
+                             "shutdown_roles", "delete_deployment")
+
+    # Besides reads, these methods have the same outcome when they're called twice.
+    IDEMPOTENT_METHODS = ("put_blob", "put_page", "create_container")
+
+    def __init__(self, rate=10, burst=20, max_attempts=6, base_delay=1, max_delay=30, busy_timeout=30 * 60):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.busy_timeout = busy_timeout
+        self.tracker = None
+
+        self._lock = threading.Lock()
+        self._deployment_locks = {}  # (service name, deployment name) -> Semaphore
+        self._held = {}  # request ID -> Semaphore
+
+    def wrap(self, service):
+        return ScheduledService(service, self)
+
+    def call(self, name, method, args, kwargs):
+        deployment_lock = None
+        if name in self.DEPLOYMENT_OPERATIONS:
+            deployment_key = self._deployment_key(args, kwargs)
+            deployment_lock = self._deployment_lock(*deployment_key)
+            with tracer.span("wait", "deployment busy", deployment="/".join(deployment_key)):
+                deployment_lock.acquire()
+
+        try:
+            result = self._call_with_retries(name, method, args, kwargs)
+        except Exception:
+            if deployment_lock is not None:
+                deployment_lock.release()
+            raise
+
+        if deployment_lock is not None:
+            # We hold on to the Deployment until the operation completes.
+            with self._lock:
+                self._held[result.request_id] = deployment_lock
+
+        return result
+
+    def operation_completed(self, request_id):
+        with self._lock:
+            deployment_lock = self._held.pop(request_id, None)
+        if deployment_lock is not None:
+            deployment_lock.release()
+
+    def _call_with_retries(self, name, method, args, kwargs):
+        attempt = 0
+        busy_since = None
+        waited_for = set()
+        while 1:
+            self.bucket.acquire()
+            try:
+                with tracer.span("api", name, **_span_args(args, kwargs)):
+                    return method(*args, **kwargs)
+            except Exception as e:
+                request_id = busy_with(e) if name in self.DEPLOYMENT_OPERATIONS else None
+                if request_id is not None:
+                    # Operations take minutes, so this gets a deadline of its own rather than a number of attempts.
+                    busy_since = busy_since or time.time()
+                    if time.time() - busy_since >= self.busy_timeout:
+                        raise
+                    # Azure may take a moment to let go of the Deployment once the operation has completed.
+                    if request_id not in waited_for and self._wait_for_operation(name, request_id):
+                        waited_for.add(request_id)
+                    else:
+                        self._backoff(name, e, self.max_delay)
+                    continue
+
+                attempt += 1
+                if attempt >= self.max_attempts or not self._retryable(name, e):
+                    raise
+                self._backoff(name, e, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _retryable(self, name, error):
+        if is_throttled(error):
+            return True
+        idempotent = name.startswith(("get_", "list_")) or name in self.IDEMPOTENT_METHODS
+        return idempotent and is_transient(error)
+
+    def _wait_for_operation(self, name, request_id):
+        # Returns whether we waited for the operation to complete.
+        if self.tracker is None:
+            return False
+        logger.warning("Call to '%s' is held back by operation '%s', waiting for it to complete", name, request_id)
+        try:
+            with tracer.span("wait", "deployment busy", request_id=request_id):
+                self.tracker.track(request_id, label="busy").result()
+        except OperationFailed:
+            # It's no longer holding the Deployment either way.
+            pass
+        except Exception as e:
+            logger.warning("Failed to wait for operation '%s': %s", request_id, e)
+            return False
+        return True
+
+    def _backoff(self, name, error, delay):
+        delay = random.uniform(delay / 2.0, delay)
+        logger.warning("Call to '%s' failed (%s), retrying in %.1fs", name, error, delay)
+        with tracer.span("backoff", name):
+            time.sleep(delay)
+
+    @staticmethod
+    def _deployment_key(args, kwargs):
+        args = list(args)
+        service_name = kwargs["service_name"] if "service_name" in kwargs else args.pop(0)
+        deployment_name = kwargs["deployment_name"] if "deployment_name" in kwargs else args.pop(0)
+        return service_name, deployment_name
+
+    def _deployment_lock(self, service_name, deployment_name):
+        with self._lock:
+            # This is a Semaphore rather than a Lock because it's released by the tracker's thread.
+            return self._deployment_locks.setdefault((service_name, deployment_name), threading.Semaphore())
+
+
+class ScheduledService(object):
+    """
+    Wraps a ServiceManagementService or BlobService so that all its API calls go through a RequestScheduler.
+    """
+
+    # These don't make any request.
+    LOCAL_METHODS = ("make_blob_url", "with_filter", "set_proxy")
+
+    def __init__(self, service, scheduler):
+        self.service = service
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        attr = getattr(self.service, name)
+        if name.startswith("_") or name in self.LOCAL_METHODS or not callable(attr):
+            return attr
+
+        def scheduled(*args, **kwargs):
+            return self.scheduler.call(name, attr, args, kwargs)
+
+        return scheduled
+
+
+class ResourceCache(object):
+    """
+    Sits in front of a ServiceManagementService, and caches Hosted Service and Deployment reads (including "this
+    doesn't exist" answers).
+
+    Cached entries are invalidated when we issue an operation that affects them, and once again when that operation
+    completes (the `operation_completed` method should be registered as a listener on the OperationTracker). Any
+    other attribute is passed through to the underlying service.
+    """
+
+    def __init__(self, sms):
+        self.sms = sms
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = {}  # (method name, service name, args) -> (result, error)
+        self._exists = set()  # (service name, deployment name) for Deployments known to exist
+        self._pending = {}  # request ID -> service name
+        self._generations = collections.Counter()  # service name -> number of times it was invalidated
+
+    def __getattr__(self, name):
+        return getattr(self.sms, name)
+
+    #########
+    # Reads #
+    #########
+
+    def get_hosted_service_properties(self, service_name, embed_detail=False):
+        return self._get("get_hosted_service_properties", service_name, embed_detail)
+
+    def get_deployment_by_name(self, service_name, deployment_name):
+        deployment = self._get("get_deployment_by_name", service_name, deployment_name)
+        with self._lock:
+            self._exists.add((service_name, deployment_name))
+        return deployment
+
+    def deployment_exists(self, service_name, deployment_name):
+        # Adding or updating Roles doesn't change whether the Deployment exists, so we remember Deployments we've
+        # seen even if the cached Deployment was invalidated.
+        with self._lock:
+            if (service_name, deployment_name) in self._exists:
+                self.hits += 1
+                return True
+        try:
+            self.get_deployment_by_name(service_name, deployment_name)
+        except WindowsAzureMissingResourceError:
+            return False
+        return True
+
+    def _get(self, method_name, service_name, *args):
+        key = (method_name, service_name, args)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            generation = self._generations.setdefault(service_name, 0)
+
+        if entry is None:
+            try:
+                entry = (getattr(self.sms, method_name)(service_name, *args), None)
+            except WindowsAzureMissingResourceError as e:
+                entry = (None, e)
+            with self._lock:
+                # If the Hosted Service was invalidated in the meantime, what we read may predate the change.
+                if self._generations[service_name] == generation:
+                    self._entries[key] = entry
+
+        result, error = entry
+        if error is not None:
+            raise error
+        return result
+
+    ##########
+    # Writes #
+    ##########
+
+    def create_hosted_service(self, service_name, *args, **kwargs):
+        self.invalidate(service_name)
+        return self.sms.create_hosted_service(service_name, *args, **kwargs)
+
+    def delete_hosted_service(self, service_name, *args, **kwargs):
+        self.invalidate(service_name, forget_deployments=True)
+        return self.sms.delete_hosted_service(service_name, *args, **kwargs)
+
+    def create_virtual_machine_deployment(self, service_name, deployment_name, *args, **kwargs):
+        return self._mutate(self.sms.create_virtual_machine_deployment, service_name, deployment_name, *args, **kwargs)
+
+    def add_role(self, service_name, deployment_name, *args, **kwargs):
+        return self._mutate(self.sms.add_role, service_name, deployment_name, *args, **kwargs)
+
+    def delete_role(self, service_name, deployment_name, *args, **kwargs):
+        return self._mutate(self.sms.delete_role, service_name, deployment_name, *args, **kwargs)
+
+    def start_roles(self, service_name, deployment_name, *args, **kwargs):
+        return self._mutate(self.sms.start_roles, service_name, deployment_name, *args, **kwargs)
+
+    def shutdown_roles(self, service_name, deployment_name, *args, **kwargs):
+        return self._mutate(self.sms.shutdown_roles, service_name, deployment_name, *args, **kwargs)
+
+    def delete_deployment(self, service_name, deployment_name, *args, **kwargs):
+        with self._lock:
+            self._exists.discard((service_name, deployment_name))
+        return self._mutate(self.sms.delete_deployment, service_name, deployment_name, *args, **kwargs)
+
+    def _mutate(self, method, service_name, deployment_name, *args, **kwargs):
+        self.invalidate(service_name)
+        operation = method(service_name, deployment_name, *args, **kwargs)
+        with self._lock:
+            self._pending[operation.request_id] = service_name
+        return operation
+
+    def operation_completed(self, request_id):
+        with self._lock:
+            service_name = self._pending.pop(request_id, None)
+        if service_name is not None:
+            self.invalidate(service_name)
+
+    def clear(self):
+        # Forget everything (e.g. because others may have changed anything since we last looked).
+        with self._lock:
+            self._entries.clear()
+            self._exists.clear()
+            for service_name in self._generations:
+                self._generations[service_name] += 1
+
+    def invalidate(self, service_name, forget_deployments=False):
+        # Operations on a Deployment are reflected in its Hosted Service's details too, so we invalidate everything
+        # that relates to the Hosted Service.
+        with self._lock:
+            self._generations[service_name] += 1
+            for key in [key for key in self._entries if key[1] == service_name]:
+                del self._entries[key]
+            if forget_deployments:
+                self._exists = set(key for key in self._exists if key[0] != service_name)
+
+
+def deployment_exists(sms, service_name, deployment_name):
+    # The ResourceCache can often answer without making an API call.
+    if hasattr(sms, "deployment_exists"):
+        return sms.deployment_exists(service_name, deployment_name)
+    try:
+        sms.get_deployment_by_name(service_name, deployment_name)
+    except WindowsAzureMissingResourceError:
+        return False
+    return True
+
+
+def invalidate_cache(sms, service_name):
+    # Forget what the ResourceCache (if there's one) knows about the Hosted Service.
+    if hasattr(sms, "invalidate"):
+        sms.invalidate(service_name)
 
 
 def random_vm_name():
     return str(uuid.uuid4())
 
-def random_port():
-    return random.randint(2**12, 2**16) - 1
+class PortAllocator(object):
+    """
+    Hands out public ports that aren't in use yet in a Deployment.
+
+    All the VMs in a Deployment share a public IP (the Hosted Service's VIP), so the public ports of their non
+    load-balanced endpoints must all be different: a collision only shows up as a failed operation, after a full
+    round trip. The allocator is built from the ports the Deployment already uses, and is safe to share between
+    threads provisioning VMs concurrently.
+    """
+
+    MIN_PORT = 2**12
+    MAX_PORT = 2**16 - 1
+
+    def __init__(self, used_ports=()):
+        self._lock = threading.Lock()
+        self._used = set(used_ports)
+
+    @classmethod
+    def from_deployment(cls, deployment):
+        used = set()
+        if deployment is not None:
+            for instance in deployment.role_instance_list:
+                used.update(int(endpoint.public_port) for endpoint in instance.instance_endpoints if endpoint.public_port)
+            # Roles that are still being provisioned might not have instance endpoints yet.
+            for role in deployment.role_list:
+                for configuration_set in role.configuration_sets:
+                    if configuration_set.configuration_set_type == "NetworkConfiguration":
+                        used.update(int(endpoint.port) for endpoint in configuration_set.input_endpoints if endpoint.port)
+        return cls(used)
+
+    @classmethod
+    def for_deployment(cls, sms, service_name, deployment_name):
+        try:
+            deployment = sms.get_deployment_by_name(service_name, deployment_name)
+        except WindowsAzureMissingResourceError:
+            deployment = None
+        return cls.from_deployment(deployment)
+
+    def reserve(self, port):
+        with self._lock:
+            self._used.add(port)
+
+    def allocate(self, port_range=None):
+        """
+        Returns a free port, and marks it as used. If a (first, last) `port_range` is passed, the lowest free port in
+        that range is returned. Otherwise, the port is picked at random.
+        """
+        with self._lock:
+            if port_range is not None:
+                first, last = port_range
+                candidates = xrange(first, last + 1)
+            else:
+                # A few random picks will almost always do, but we don't want to loop forever on a crowded Deployment.
+                candidates = itertools.chain(random.sample(xrange(self.MIN_PORT, self.MAX_PORT + 1), 32),
+                                             xrange(self.MIN_PORT, self.MAX_PORT + 1))
+
+            for port in candidates:
+                if port not in self._used:
+                    self._used.add(port)
+                    return port
+
+        raise ValueError("No free port left in {0}".format(port_range or "the Deployment"))
+
+
+def get_shards(config):
+    """
+    Returns the (service_name, deployment_name) pairs the cluster is spread across.
+
+    Azure runs a single Role operation at a time in a given Deployment, so provisioning a large cluster in a single
+    Deployment takes time proportional to its size. Spreading the cluster across several Hosted Services lets us
+    provision those in parallel.
+    """
+    if "shards" not in config:
+        return [(config.service_name, config.deployment_name)]
+
+    count = config.shards.count
+    if not isinstance(count, int) or count < 1:
+        raise ValueError("Invalid shard count in the configuration: {0!r} (it must be a whole number, at least 1)".format(count))
+
+    shards = [(config.shards.service_name_tpl.format(shard=shard), config.shards.deployment_name_tpl.format(shard=shard))
+              for shard in range(count)]
+
+    # A Hosted Service only takes one (Production) Deployment: shards that share one would fail to provision, and only
+    # after a while.
+    service_names = [service_name for service_name, _ in shards]
+    duplicates = sorted(set(name for name in service_names if service_names.count(name) > 1))
+    if duplicates:
+        raise ValueError("Several shards are in the same Hosted Service ({0}): `service_name_tpl` ({1!r}) must use "
+                         "{{shard}}".format(", ".join(duplicates), config.shards.service_name_tpl))
+    return shards
+
+
+def split_vms(n_vms, n_shards):
+    # Spread the VMs as evenly as possible
+    return [n_vms // n_shards + (1 if shard < n_vms % n_shards else 0) for shard in range(n_shards)]
+
+
+def for_each_shard(shards, fn):
+    """
+    Calls `fn(service_name, deployment_name)` for every shard, in parallel, and returns the results.
+    """
+    executor = ThreadPoolExecutor(max_workers=len(shards))
+    try:
+        futures = [executor.submit(fn, service_name, deployment_name) for service_name, deployment_name in shards]
+        wait_for_all(futures)
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False)
 
 
 def create_hosted_service(sms, service_name, service_location):
@@ -82,129 +1302,235 @@ def create_hosted_service(sms, service_name, service_location):
             logger.warning("Service '%s' exists, but its Location is '%s', not: %s'.", service_name, real_location, service_location)
 
 
-def deploy_vm(sms, bs, service_name, deployment_name, network_name, vhds_container, vm_config):
-
-    vm_name = random_vm_name()
-    format_kwargs = {"vm_name": vm_name}
-
-    logger.info("Deploying '%s' in '%s/%s'", vm_name, service_name, deployment_name)
+class _Template(object):
+    """
+    A `_tpl` field of the VM configuration, parsed (and checked) once, and rendered for each VM.
+    """
+
+    # What templates get to use.
+    FIELDS = ("vm_name",)
+
+    _formatter = string.Formatter()
+
+    def __init__(self, path, tpl):
+        try:
+            self._pieces = list(self._formatter.parse(tpl))
+            for _, field_name, _, _ in self._pieces:
+                if field_name is None:
+                    continue
+                root = field_name.split(".")[0].split("[")[0]
+                if root not in self.FIELDS:
+                    raise ValueError("unknown field '{0}' (you can use: {1})".format(root, ", ".join(self.FIELDS)))
+            # Format specs and conversions are only checked when rendering.
+            self.render("00000000-0000-0000-0000-000000000000")
+        except (ValueError, AttributeError, IndexError, KeyError, TypeError) as e:
+            raise ValueError("Invalid template in the VM configuration at '{0}' ({1!r}): {2}".format(path, tpl, e))
+
+    def render(self, vm_name):
+        fields = {"vm_name": vm_name}
+        rendered = []
+        for literal, field_name, format_spec, conversion in self._pieces:
+            rendered.append(literal)
+            if field_name is not None:
+                value, _ = self._formatter.get_field(field_name, (), fields)
+                value = self._formatter.convert_field(value, conversion)
+                rendered.append(self._formatter.format_field(value, format_spec))
+        return "".join(rendered)
+
+
+VMPayload = collections.namedtuple("VMPayload", ["vm_name", "disk_name", "blobs", "role"])
+
+
+class VMTemplate(object):
+    """
+    A VM configuration, compiled: all its `_tpl` fields are parsed and checked up front (so that a mistake shows up
+    before we make any API call, rather than on the 37th VM), and then rendered into the payloads of the API calls
+    that create VMs, for a whole batch of VMs at once.
+    """
+
+    def __init__(self, vm_config):
+        self.vm_config = vm_config
+        self.nat_ports = list(vm_config.net.nat_ports)
+        self.subnet_names = list(vm_config.net.subnet_names)
+        self.public_ip_names = [_Template("net.public_ip_name_tpls[{0}]".format(i), tpl)
+                                for i, tpl in enumerate(vm_config.net.public_ip_name_tpls)]
+        self.source_image = vm_config.root_disk.source_image
+        self.root_disk_name = _Template("root_disk.name_tpl", vm_config.root_disk.name_tpl)
+        self.data_disks = [(_Template("data_disks[{0}].url_tpl".format(i), disk_config.url_tpl), disk_config.size_gb)
+                           for i, disk_config in enumerate(vm_config.data_disks)]
+        self.host_name = _Template("system.host_name_tpl", vm_config.system.host_name_tpl)
+        self.user_data = _Template("system.user_data_tpl", vm_config.system.user_data_tpl)
+        self.size = vm_config.size
+
+    def render(self, vm_names, port_allocator, blob_url):
+        """
+        Returns a VMPayload for each VM name. `port_allocator` hands out the public ports of the VMs, and
+        `blob_url(blob_name)` returns the URL of a blob in the VHDs container.
+        """
+        for nat_port in self.nat_ports:
+            if nat_port.lb:
+                port_allocator.reserve(nat_port.port)
+
+        # The agent on the VMs insists on a password (see below): we draw them all at once.
+        entropy = os.urandom(32 * len(vm_names))
+
+        return [self._render(vm_name, port_allocator, blob_url, entropy[32 * i:32 * (i + 1)])
+                for i, vm_name in enumerate(vm_names)]
+
+    def _render(self, vm_name, port_allocator, blob_url, entropy):
+
+        #########################
+        # Network Configuration #
+        #########################
+
+        network_configuration = ConfigurationSet()
+
+        for nat_port in self.nat_ports:
+            # At a minimum, a NAT port requires the traffic we expect to serve.
+            nat_port_kwargs = {
+                "name": nat_port.name,
+                "protocol": nat_port.protocol,
+                "local_port": nat_port.port
+            }
+            if nat_port.lb:
+                # If a port is load-balanced, multiple VMs can use the same one, but we must indicate to the
+                # API that this is what we wanted to do.
+                nat_port_kwargs.update({
+                    "port": nat_port.port,
+                    "load_balanced_endpoint_set_name": "lb-{0}".format(nat_port.name)
+                })
+            else:
+                # If the port isn't load balanced, then each VM gets its own port (picked from `public_port_range` if
+                # there is one, at random otherwise).
+                nat_port_kwargs.update({
+                    "port": port_allocator.allocate(nat_port.get("public_port_range"))
+                })
+            network_configuration.input_endpoints.input_endpoints.append(ConfigurationSetInputEndpoint(**nat_port_kwargs))
+
+        for subnet_name in self.subnet_names:
+            # All these Subnets must belong to the Virtual Network used for the VM Deployment.
+            # Note that it appears that providing multiple subnets is not useful, and results in the
+            # first subnet only being used (at least according to the console).
+            network_configuration.subnet_names.append(subnet_name)
+
+        for public_ip_name in self.public_ip_names:
+            # Note that for some reason, not giving the IPs a name results in some form of conflict (which does *not* throw an error),
+            # where only one instance will get a Public IP. Giving the IPs a name seems to resolve the issue (note that it doesn't seem to
+            # matter whether that name is unique or not, but if we're giving the IP a name, we might as well make it unique)
+            network_configuration.public_ips.public_ips.append(PublicIP(name=public_ip_name.render(vm_name)))
+
+
+        ###########################
+        # Root Disk Configuration #
+        ###########################
+
+        # Disks are composed of two things:
+        #   + A "disk" entity that can be attached to VMs, and is little more than a pointer to the underlying blob.
+        #   + A "blob" that is stored in Azure's blob storage, and is the actual container for the disk bytes.
+
+        # In this case, our disk is a OS disk, so it also has a source Image. Source images are OS Images, and they
+        # can be listed using: `sms.list_os_images()`.
+
+        disk_name = self.root_disk_name.render(vm_name)
+        disk_url = blob_url("{disk_name}.vhd".format(disk_name=disk_name))
+
+        root_disk_configuration = OSVirtualHardDisk(
+            source_image_name = self.source_image,
+            disk_name = disk_name,
+            media_link = disk_url
+        )
+
+
+        #############################
+        # Extra Disks Configuration #
+        #############################
+
+        # Configure some extra disks for this host. Note that there are some limitations on the number of disks that may be
+        # attached to a VM: http://msdn.microsoft.com/en-us/library/dn197896.aspx
+
+        extra_disks_configuration = DataVirtualHardDisks()
+        for i, (url, size_gb) in enumerate(self.data_disks):
+            # It is beyond me why the SDK doesn't allow us to configure this disk through the constructor.
+            disk = DataVirtualHardDisk()
+            disk.lun = i
+            disk.media_link = url.render(vm_name)
+            disk.logical_disk_size_in_gb = size_gb
+            extra_disks_configuration.data_virtual_hard_disks.append(disk)
+
+
+        ####################
+        # OS Configuration #
+        ####################
+
+        # This configuration is a mixed bag of things we don't need that are required, and things we don't need that
+        # aren't. Specifically, the agent (waagent) that Azures has on our VM requires that we create a new user,
+        # and give it a password. We don't really want to use that, but we don't really have a choice, either.
+
+        # Note that the agent seems optional, and we can pass `provision_guest_agent = False` to the
+        # `sms.create_virtual_machine_deployment` / `sms.add_role` API Call to indicate that.
+
+        # The host name is mandatory too, and will be (as far as I can tell) processed by waagent too. However,
+        # the `custom_data` will (fortunately) be passed as user-data that will be processed by cloud-init:
+        # http://azure.microsoft.com/blog/2014/04/21/custom-data-and-cloud-init-on-windows-azure/
+
+        system_configuration = LinuxConfigurationSet(
+            # Plenty of stuff we don't need!
+            user_name = "thomas",
+            user_password = base64.b64encode(entropy),
+            disable_ssh_password_authentication = True,
+
+            # Finally, something we need!
+            host_name = self.host_name.render(vm_name),
+            custom_data = self.user_data.render(vm_name),
+        )
+
+        role = {
+            "role_name" : vm_name,
+            "os_virtual_hard_disk" : root_disk_configuration,
+            "data_virtual_hard_disks": extra_disks_configuration,
+            "system_config" : system_configuration,
+            "network_config" : network_configuration,
+
+            "role_size" : self.size,
+        }
+        blobs = [disk_url] + [disk.media_link for disk in extra_disks_configuration]
+        return VMPayload(vm_name, disk_name, blobs, role)
 
-    ##################
-    # Disk Container #
-    ##################
-    # We must first ensure that the container where we will place the VHDs for the VM exists. The container is a
-    # directory within the Storage Account (somewhat akin to a bucket in AWS).
 
+def render_vms(bs, vhds_container, template, n_vms, port_allocator):
+    """
+    Render the payloads of `n_vms` new VMs (see VMTemplate.render), and make sure their VHDs have somewhere to go.
+    """
+    # The container is a directory within the Storage Account (somewhat akin to a bucket in AWS), where we place the
+    # VHDs of the VMs.
     bs.create_container(vhds_container, fail_on_exist=False)
-
-
-    #########################
-    # Network Configuration #
-    #########################
-    # NOTE: This only depends on vm_name and vm_config, so it could be extracted into a function
-
-    network_configuration = ConfigurationSet()
-
-    for nat_port in vm_config.net.nat_ports:
-        # At a minimum, a NAT port requires the traffic we expect to serve.
-        nat_port_kwargs = {
-            "name": nat_port.name,
-            "protocol": nat_port.protocol,
-            "local_port": nat_port.port
-        }
-        if nat_port.lb:
-            # If a port is load-balanced, multiple VMs can use the same one, but we must indicate to the
-            # API that this is what we wanted to do.
-            nat_port_kwargs.update({
-                "port": nat_port.port,
-                "load_balanced_endpoint_set_name": "lb-{0}".format(nat_port.name)
-            })
-        else:
-            # If the port isn't load balanced, then each VM gets its own random port.
-            nat_port_kwargs.update({
-                "port": random_port()
-            })
-        network_configuration.input_endpoints.input_endpoints.append(ConfigurationSetInputEndpoint(**nat_port_kwargs))
-
-    for subnet_name in vm_config.net.subnet_names:
-        # All these Subnets must belong to the Virtual Network used for the VM Deployment.
-        # Note that it appears that providing multiple subnets is not useful, and results in the
-        # first subnet only being used (at least according to the console).
-        network_configuration.subnet_names.append(subnet_name)
-
-    for public_ip_name_tpl in vm_config.net.public_ip_name_tpls:
-        # Note that for some reason, not giving the IPs a name results in some form of conflict (which does *not* throw an error),
-        # where only one instance will get a Public IP. Giving the IPs a name seems to resolve the issue (note that it doesn't seem to
-        # matter whether that name is unique or not, but if we're giving the IP a name, we might as well make it unique)
-        network_configuration.public_ips.public_ips.append(PublicIP(name=public_ip_name_tpl.format(**format_kwargs)))
-
-
-    ###########################
-    # Root Disk Configuration #
-    ###########################
-    # NOTE: Same as above
-
-    # Disks are composed of two things:
-    #   + A "disk" entity that can be attached to VMs, and is little more than a pointer to the underlying blob.
-    #   + A "blob" that is stored in Azure's blob storage, and is the actual container for the disk bytes.
-
-    # In this case, our disk is a OS disk, so it also has a source Image. Source images are OS Images, and they
-    # can be listed using: `sms.list_os_images()`.
-
-    disk_name = vm_config.root_disk.name_tpl.format(**format_kwargs)
-    disk_url = bs.make_blob_url(vhds_container, "{disk_name}.vhd".format(disk_name=disk_name))
-
-    root_disk_configuration = OSVirtualHardDisk(
-        source_image_name = vm_config.root_disk.source_image,
-        disk_name = disk_name,
-        media_link = disk_url
-    )
-
-
-    #############################
-    # Extra Disks Configuration #
-    #############################
-    # NOTE: Same as above
-
-    # Configure some extra disks for this host. Note that there are some limitations on the number of disks that may be
-    # attached to a VM: http://msdn.microsoft.com/en-us/library/dn197896.aspx
-
-    extra_disks_configuration = DataVirtualHardDisks()
-    for i, disk_config in enumerate(vm_config.data_disks):
-        # It is beyond me why the SDK doesn't allow us to configure this disk through the constructor.
-        disk = DataVirtualHardDisk()
-        disk.lun = i
-        disk.media_link = disk_config.url_tpl.format(**format_kwargs)
-        disk.logical_disk_size_in_gb = disk_config.size_gb
-        extra_disks_configuration.data_virtual_hard_disks.append(disk)
-
-
-    ####################
-    # OS Configuration #
-    ####################
-    # NOTE: Same as above
-
-    # This configuration is a mixed bag of things we don't need that are required, and things we don't need that
-    # aren't. Specifically, the agent (waagent) that Azures has on our VM requires that we create a new user,
-    # and give it a password. We don't really want to use that, but we don't really have a choice, either.
-
-    # Note that the agent seems optional, and we can pass `provision_guest_agent = False` to the
-    # `sms.create_virtual_machine_deployment` / `sms.add_role` API Call to indicate that.
-
-    # The host name is mandatory too, and will be (as far as I can tell) processed by waagent too. However,
-    # the `custom_data` will (fortunately) be passed as user-data that will be processed by cloud-init:
-    # http://azure.microsoft.com/blog/2014/04/21/custom-data-and-cloud-init-on-windows-azure/
-
-    system_configuration = LinuxConfigurationSet(
-        # Plenty of stuff we don't need!
-        user_name = "thomas",
-        user_password = base64.b64encode(open("/dev/urandom").read(32)),
-        disable_ssh_password_authentication = True,
-
-        # Finally, something we need!
-        host_name = vm_config.system.host_name_tpl.format(**format_kwargs),
-        custom_data = vm_config.system.user_data_tpl.format(**format_kwargs),
-    )
+    return template.render([random_vm_name() for _ in range(n_vms)], port_allocator,
+                           lambda blob_name: bs.make_blob_url(vhds_container, blob_name))
+
+
+def payload_to_dict(payload):
+    """
+    A JSON-friendly version of a VMPayload (for `--dry-run`), without the VM's password.
+    """
+    def to_dict(value):
+        if isinstance(value, (list, tuple)):
+            return [to_dict(item) for item in value]
+        if isinstance(value, dict):
+            return dict((key, to_dict(item)) for key, item in value.items())
+        if hasattr(value, "__dict__"):
+            return dict((key, to_dict(item)) for key, item in vars(value).items()
+                        if item is not None and key != "user_password")
+        return value
+
+    return dict(to_dict(payload.role), disk_name=payload.disk_name)
+
+
+def deploy_vm(sms, tracker, service_name, deployment_name, network_name, payload):
+    """
+    Create the VM rendered in `payload`. Returns the VM's name, and a Future that resolves once it's created.
+    """
+    vm_name = payload.vm_name
+    logger.info("Deploying '%s' in '%s/%s'", vm_name, service_name, deployment_name)
 
     ############
     # API Call #
@@ -214,20 +1540,12 @@ def deploy_vm(sms, bs, service_name, deployment_name, network_name, vhds_contain
     # only needed ot identify what Deployment we want to add the VM to. The rest is configuration for
     # the VM itself.
 
-    kwargs = {
+    kwargs = dict(payload.role)
+    kwargs.update({
         # Identify what this VM belongs to
         "service_name" : service_name,
         "deployment_name" : deployment_name,
-
-        # Actual VM creation params
-        "role_name" : vm_name,
-        "os_virtual_hard_disk" : root_disk_configuration,
-        "data_virtual_hard_disks": extra_disks_configuration,
-        "system_config" : system_configuration,
-        "network_config" : network_configuration,
-
-        "role_size" : vm_config.size,
-    }
+    })
 
     # One trick in the Azure API is that a VM Deployment can only be created when you create its first VM
     # (and symetrically, you can't delete the last VM of a Deployment, and must delete the Deployment
@@ -236,9 +1554,7 @@ def deploy_vm(sms, bs, service_name, deployment_name, network_name, vhds_contain
     # `create_virtual_machine_deployment` API Call to create it and create our VM. If it does exist, then
     # we just add a new VM to the Deployment.
 
-    try:
-        sms.get_deployment_by_name(service_name, deployment_name)
-    except WindowsAzureMissingResourceError:
+    if not deployment_exists(sms, service_name, deployment_name):
         logger.info("Deployment '%s' does not exist in Service '%s'", deployment_name, service_name)
         method = sms.create_virtual_machine_deployment
         # The kwargs we add here are required for the creation of a Deployment. Specfically, we need to pass
@@ -259,17 +1575,115 @@ def deploy_vm(sms, bs, service_name, deployment_name, network_name, vhds_contain
         # We're just adding a new VM, no additional kwargs are required.
         method = sms.add_role
 
-    # Finally, we make the call. It's asynchronous, so we wait on it.
+    # Finally, we make the call. It's asynchronous, so we return a Future the caller can wait on. We record what we're
+    # about to do first: if we crash before we get to record the request ID, the next run can still find out whether
+    # the VM exists.
+    journal.record("deploy", vm_name, service_name=service_name, deployment_name=deployment_name, state="issuing",
+                   disks=[payload.disk_name], blobs=payload.blobs)
     operation = method(**kwargs)
-    wait_for_operation(sms, operation)
-    logger.info("VM '%s' is ready", vm_name)
 
+    def on_done(future):
+        if future.exception() is None:
+            logger.info("VM '%s' is ready", vm_name)
+
+    return vm_name, journal.track(tracker, "deploy", vm_name, operation, on_done)
+
+
+def resume_deploys(sms, tracker, service_name, deployment_name):
+    """
+    Wait for the VMs that a previous run (according to the journal) was deploying in a Deployment, and return the
+    names of all the VMs it deployed there.
+    """
+    deployed = []
+    role_names = None
+    for step in journal.steps("deploy", service_name=service_name, deployment_name=deployment_name):
+        vm_name = step["key"]
+        if step["state"] == "issuing":
+            # We don't know whether the operation was issued, but we can tell whether the VM exists.
+            if role_names is None:
+                try:
+                    role_names = set(role.role_name for role in sms.get_deployment_by_name(service_name, deployment_name).role_list)
+                except WindowsAzureMissingResourceError:
+                    role_names = set()
+            if vm_name in role_names:
+                deployed.append(vm_name)
+            else:
+                # The VM may also be still deploying (it only shows up once it's done).
+                logger.warning("The previous run may or may not have started deploying '%s': if it did, it'll show "
+                               "up as an extra VM", vm_name)
+        elif step["state"] == "issued":
+            logger.info("Reattaching to the deployment of '%s'", vm_name)
+            try:
+                journal.reattach(tracker, "deploy", vm_name, step["request_id"]).result()
+            except OperationFailed as e:
+                logger.warning("VM '%s' failed to deploy: %s", vm_name, e)
+                continue
+            deployed.append(vm_name)
+        elif step["state"] == "succeeded":
+            deployed.append(vm_name)
+
+    if deployed:
+        logger.info("%s VMs were already deployed in '%s/%s' by a previous run", len(deployed), service_name,
+                    deployment_name)
+        # Operations we didn't issue in this run may have changed the Deployment under our feet.
+        invalidate_cache(sms, service_name)
+    return deployed
+
+
+def add_vms(sms, bs, tracker, service_name, deployment_name, network_name, vhds_container, template, n_vms,
+            port_allocator, on_added=None):
+    """
+    Add `n_vms` VMs rendered from `template` to a Deployment, and return their names. If `on_added` is passed, it's
+    called with the name of each VM as soon as it's added.
+    """
+    vm_names = []
+    for payload in render_vms(bs, vhds_container, template, n_vms, port_allocator):
+        # Azure only runs one Role operation at a time in a given Deployment, so we wait for each VM before adding the
+        # next one.
+        vm_name, future = deploy_vm(sms, tracker, service_name, deployment_name, network_name, payload)
+        future.result()
+        vm_names.append(vm_name)
+        if on_added is not None:
+            on_added(vm_name)
+    return vm_names
+
+
+def deallocate(sms, tracker, service_name, deployment_name, role_names):
+    """
+    Stop VMs (so that we stop paying for them) with a single operation, and wait for it.
+    """
+    op = sms.shutdown_roles(service_name, deployment_name, role_names, post_shutdown_action="StoppedDeallocated")
+    tracker.track(op, label=deployment_name).result()
+
+
+def resume_operations(sms, tracker, service_name, deployment_name):
+    """
+    Wait for the operations that a previous run (according to the journal) left in flight on a Deployment, and clean
+    up the Disks of the VMs it removed from there.
+    """
+    steps = journal.steps(service_name=service_name, deployment_name=deployment_name)
+    if not steps:
+        return
 
-def test_ssh(sms, service_name, deployment_name):
-    logger.info("Retrieving list of VMs and ports")
-    deployment = sms.get_deployment_by_name(service_name, deployment_name)
-    ssh_targets = []
+    reaper = DiskReaper(sms)
+    for step in steps:
+        if step["state"] == "issued":
+            logger.info("Waiting for '%s' on '%s' (issued by a previous run)", step["kind"], step["key"])
+            future = journal.reattach(tracker, step["kind"], step["key"], step["request_id"])
+            try:
+                future.result()
+            except OperationFailed as e:
+                logger.warning("'%s' on '%s' failed: %s", step["kind"], step["key"], e)
+        else:
+            future = journal.resume(tracker, step["kind"], step["key"])
+        if step["kind"] in ("delete_role", "delete_deployment") and future is not None:
+            reaper.add_after(future, step["disks"])
+
+    invalidate_cache(sms, service_name)
+    reaper.run()
 
+
+def ssh_targets(deployment, role_names=None):
     # Let's stop for a minute to talk about deployment.role_instance_list and deployment.role_list.
 
     # `deployment.role_list` is pretty much a list of what you requested when you provisioned the instance. It includes
@@ -282,190 +1696,1516 @@ def test_ssh(sms, service_name, deployment_name):
     # a role_type field in the objects it returns).
     # Fortunately, every API Call returns both items.
 
+    targets = []
+
     for vm in deployment.role_instance_list:
+        if role_names is not None and vm.role_name not in role_names:
+            continue
         for endpoint in vm.instance_endpoints:
             # Note: the endpoint ports are strings. Not that this makes sense, but we have to convert
             # those to ints.
             if int(endpoint.local_port) == 22:
-                ssh_targets.append((vm.instance_name, endpoint.vip, int(endpoint.public_port)))
+                targets.append((vm.instance_name, endpoint.vip, int(endpoint.public_port)))
         if not vm.public_ips:
             logger.warning("VM %s has no public IPs", vm.instance_name)
         else:
             for public_ip in vm.public_ips:
-                ssh_targets.append((vm.instance_name, public_ip.address, 22))
-
-    logger.info("SSH Targets: %s", ssh_targets)
-    while ssh_targets:
-        ssh_target = ssh_targets.pop(0)
-        logger.debug("Trying to hit SSH on %s at %s:%s", *ssh_target)
-        if ssh_up(*ssh_target):
-            logger.info("SSH is up on %s at %s:%s", *ssh_target)
-        else:
-            logger.info("SSH is not up on %s at %s:%s", *ssh_target)
-            ssh_targets.append(ssh_target)
-            time.sleep(1)
+                targets.append((vm.instance_name, public_ip.address, 22))
+
+    return targets
 
 
-def teardown(sms, service_name):
+def test_ssh(sms, shards, prober):
+    logger.info("Retrieving list of VMs and ports")
+    targets = []
+    for service_name, deployment_name in shards:
+        deployment = sms.get_deployment_by_name(service_name, deployment_name)
+        targets.extend(ssh_targets(deployment))
+
+    logger.info("SSH Targets: %s", targets)
+    time_to_ssh = prober.probe(targets)
+
+    for name, elapsed in sorted(time_to_ssh.items(), key=lambda item: item[1]):
+        logger.info("SSH was up on %s after %.1fs", name, elapsed)
+    if time_to_ssh:
+        elapsed = time_to_ssh.values()
+        logger.info("SSH is up on %s VMs (p50: %.1fs, p95: %.1fs, max: %.1fs)", len(elapsed),
+                    percentile(elapsed, 50), percentile(elapsed, 95), max(elapsed))
+
+    return time_to_ssh
+
+
+class DiskReaper(object):
+    """
+    Deletes Disks (and their VHDs) as soon as they are detached from their VM.
+
+    Disk state is refreshed with a single listing of all the Disks in the subscription per poll interval (rather than
+    one request per Disk), and detached Disks are deleted in parallel.
+    """
+
+    def __init__(self, sms, poll_interval=5, concurrency=8):
+        self.sms = sms
+        self.poll_interval = poll_interval
+        self.concurrency = concurrency
+
+        self._cond = threading.Condition()
+        self._pending = 0  # Operations that will add more Disks once they complete
+        self._waiting = set()  # Disks we're waiting to see detached
+        self._deleting = set()  # Disks we're deleting
+        self._errors = []
+
+    def add_after(self, operation, disk_names):
+        """
+        Delete the Disks once `operation` (the Future for the deletion of their VMs) succeeds.
+        """
+        with self._cond:
+            self._pending += 1
+
+        def on_done(future):
+            with self._cond:
+                self._pending -= 1
+                if future.exception() is None:
+                    self._waiting.update(disk_names)
+                self._cond.notify()
+
+        operation.add_done_callback(on_done)
+
+    def run(self):
+        """
+        Delete Disks until there are none left to delete.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        next_listing_at = 0
+        try:
+            while 1:
+                with self._cond:
+                    if not (self._pending or self._waiting or self._deleting):
+                        break
+                    # We list the Disks at most once per poll interval, no matter how many we're waiting on.
+                    delay = next_listing_at - time.time()
+                    if not self._waiting or delay > 0:
+                        self._cond.wait(delay if self._waiting else self.poll_interval)
+                        continue
+                    waiting = set(self._waiting)
+
+                next_listing_at = time.time() + self.poll_interval
+                self._reap(executor, waiting)
+        finally:
+            executor.shutdown(wait=True)
+
+        if self._errors:
+            raise self._errors[0]
+
+    def _reap(self, executor, waiting):
+        disks = dict((disk.name, disk) for disk in self.sms.list_disks())
+
+        for name in waiting:
+            disk = disks.get(name)
+            if disk is None:
+                logger.info("Disk '%s' was already deleted", name)
+                with self._cond:
+                    self._waiting.discard(name)
+                continue
+
+            if disk.attached_to is not None:
+                logger.debug("Disk '%s' is still attached to '%s'", name, disk.attached_to.role_name)
+                continue
+
+            # Disk is no longer attached; we can finally delete. We make sure to also delete the underlying VHD (i.e.
+            # the blob in Azure storage)
+            logger.info("Deleting Disk '%s'", name)
+            with self._cond:
+                self._waiting.discard(name)
+                self._deleting.add(name)
+            executor.submit(self.sms.delete_disk, name, delete_vhd=True).add_done_callback(self._deleted(name))
+
+    def _deleted(self, name):
+        def on_done(future):
+            with self._cond:
+                self._deleting.discard(name)
+                error = future.exception()
+                if isinstance(error, WindowsAzureConflictError):
+                    # The Disk was reported as detached, but Azure isn't done with it yet. We'll try again later.
+                    logger.debug("Disk '%s' could not be deleted yet: %s", name, error)
+                    self._waiting.add(name)
+                elif error is not None:
+                    logger.error("Failed to delete Disk '%s': %s", name, error)
+                    self._errors.append(error)
+                self._cond.notify()
+        return on_done
+
+
+def teardown(sms, tracker, service_names, poll_interval=5):
     # NOTE: This does NOT delete OS Images!
+    reaper = DiskReaper(sms, poll_interval=poll_interval)
+    services_to_delete = []
+    delete_operations = []
+
+    # If we're resuming a run, it may have deleted (or started deleting) some Deployments already. Their Disks are
+    # only in the journal now.
+    resumed = set()
+    for step in journal.steps("delete_deployment"):
+        if step["service_name"] not in service_names:
+            continue
+        future = journal.resume(tracker, "delete_deployment", step["key"])
+        if future is not None:
+            reaper.add_after(future, step["disks"])
+            delete_operations.append(future)
+            resumed.add((step["service_name"], step["deployment_name"]))
+
+    for service_name in service_names:
+        try:
+            service = sms.get_hosted_service_properties(service_name, embed_detail = True)
+        except WindowsAzureMissingResourceError:
+            logger.info("Service '%s' was already deleted", service_name)
+            continue
+
+        services_to_delete.append(service_name)
+
+        for deployment in service.deployments:
+            if (service_name, deployment.name) in resumed:
+                continue
+
+            # Deleting a Deployment (or deleting VMs, for that matter) will not delete the Disks associated with them,
+            # so we start by getting a list of the Disks we'll need to cleanup.
+            disk_names = []
+            for role in deployment.role_list:
+                disk_names.append(role.os_virtual_hard_disk.disk_name)
+                disk_names.extend(disk.disk_name for disk in role.data_virtual_hard_disks)
+                # Note that we shouldn't try to also delete the VMs here. This would fail for the last VM because you
+                # need to delete the entire Deployment when deleting the last VM.
+
+            # Deployments are independent from one another, so we delete them all at once.
+            logger.info("Deleting Deployment '%s'", deployment.name)
+            op = sms.delete_deployment(service_name, deployment.name)
+            future = journal.track(tracker, "delete_deployment", "{0}/{1}".format(service_name, deployment.name), op,
+                                   service_name=service_name, deployment_name=deployment.name, disks=disk_names)
+            reaper.add_after(future, disk_names)
+            delete_operations.append(future)
+
+    # Although we wait for the delete operation to complete on the Deployment, Azure actually doesn't guarantee
+    # (though they don't document that anywhere) that our disks will be detached when that operation has completed.
+    # In fact, the disks will always remain attached for a little while after the VM has been deleted. The reaper
+    # therefore polls the disks until they have finally been detached, before attempting to delete them (attempting to
+    # delete an attached disk would of course fail).
+    reaper.run()
+    wait_for_all(delete_operations)
+
+    for service_name in services_to_delete:
+        logger.info("Deleting Service '%s'", service_name)
+        sms.delete_hosted_service(service_name)
+
+
+SNAPSHOT_BLOB_PREFIX = "image-from-"
+
+
+def snapshot(sms, tracker, copy_watcher, shards, snapshot_config):
+    started_at = time.time()
+    image_operations = []
+
+    for service_name, deployment_name in shards:
+        # This is where things get really weird. We have two lists: one that contains root volumes, and
+        # one that contains instance states!
+        deployment = sms.get_deployment_by_name(service_name, deployment_name)
+        role_names_to_vhds = dict(((role.role_name, role.os_virtual_hard_disk) for role in deployment.role_list))
+
+        # All the copies are started at once (they're performed server-side), and each Image is registered as soon as
+        # its own copy completes.
+        for role in deployment.role_instance_list:
+            root_vhd = role_names_to_vhds[role.role_name]
+            image_operations.append(snapshot_role(sms, tracker, copy_watcher, snapshot_config, role, root_vhd))
+
+    wait_for_all(image_operations)
+
+    if image_operations:
+        size = sum(future.result().size for future in image_operations)
+        duration = time.time() - started_at
+        logger.info("Created %s Images (%.1f GB) in %.0fs (%.1f MB/s)", len(image_operations), size / 2.0 ** 30,
+                    duration, size / 2.0 ** 20 / max(duration, 1e-3))
+
+
+def snapshot_role(sms, tracker, copy_watcher, snapshot_config, role, root_vhd):
+    """
+    Copy the role's root VHD, and register it as an OS Image once the copy has completed. The returned Future resolves
+    to the copy's CopyStats once the Image is registered.
+    """
+    logger.info("Preparing to snapshot '%s'. Make you sure you ran `waagent --deallocate`!", role.role_name)
+
+    if role.instance_status not in ("Stopped", "StoppedDeallocated"):
+        logger.warning("Role '%s' is in '%s' state. Snapshotting is risky!", role.role_name, role.instance_status)
+
+    format_kwargs = {"role": role}
+    os_label = snapshot_config.label_tpl.format(**format_kwargs)
+    os_name = snapshot_config.name_tpl.format(**format_kwargs)
+    os_type = snapshot_config.os
+
+    # TODO - Lease problem here? Seems like there isn't.
+    dst_blob_name = "{0}{1}.vhd".format(SNAPSHOT_BLOB_PREFIX, role.role_name)
+    dst_blob_url = copy_watcher.bs.make_blob_url(copy_watcher.container_name, dst_blob_name)
+
+    image = Future()
+
+    # If we're resuming a run, it may have gotten some of the way already.
+    step = journal.get("snapshot", role.role_name)
+    state = step["state"] if step is not None else None
+    if state in ("issued", "succeeded"):
+        stats = CopyStats(dst_blob_name, step["size"], step["duration"])
+        chain(journal.resume(tracker, "snapshot", role.role_name), image, lambda _: stats)
+        return image
+
+    def register(copy):
+        # The Image can only be registered once the blob is fully copied: until then, it's not a usable VHD.
+        if copy.exception() is not None:
+            image.set_exception(copy.exception())
+            return
+        stats = copy.result()
+        journal.record("snapshot", role.role_name, state="copied", size=stats.size, duration=stats.duration)
+        try:
+            op = sms.add_os_image(os_label, dst_blob_url, os_name, os_type)
+        except Exception as e:
+            image.set_exception(e)
+            return
+        chain(journal.track(tracker, "snapshot", role.role_name, op, _log_created_image(os_name)), image,
+              lambda _: stats)
+
+    if state == "copied":
+        copy = Future()
+        copy.set_result(CopyStats(dst_blob_name, step["size"], step["duration"]))
+    elif state == "copying":
+        logger.info("Resuming the copy to '%s'", dst_blob_name)
+        copy = copy_watcher.watch(dst_blob_name)
+    else:
+        copy = copy_watcher.copy(dst_blob_name, root_vhd.media_link)
+        journal.record("snapshot", role.role_name, state="copying", blobs=[dst_blob_url], image=os_name)
+    copy.add_done_callback(register)
+    return image
+
+
+def _log_created_image(os_name):
+    def on_done(future):
+        if future.exception() is None:
+            logger.info("Created OS: '%s'", os_name)
+    return on_done
+
+
+
+################
+# Image Upload #
+################
+# Besides snapshotting a VM, we can make an Image out of a VHD we built locally. VHDs are uploaded as page blobs, which
+# are written in 512-byte pages: pages that are never written read as zeroes. Images are mostly empty space, so we
+# only upload the pages that aren't all zeroes.
+
+UPLOADED_BLOB_PREFIX = "image-upload-"
+PAGE_SIZE = 512
+# Azure takes at most 4 MB per page write.
+MAX_PAGE_WRITE = 4 * 2 ** 20
+
+_ZERO_PAGE = b"\0" * PAGE_SIZE
+
+
+def nonzero_ranges(data, size, chunk_size=MAX_PAGE_WRITE):
+    """
+    Yields the (start, end) ranges (end excluded) of `data` (e.g. an mmap) made of pages that aren't all zeroes, in
+    order, and each at most `chunk_size` long.
+    """
+    for chunk_start in xrange(0, size, chunk_size):
+        chunk = data[chunk_start:chunk_start + chunk_size]
+        # Checking the whole chunk at once is much faster than going page by page, and most chunks are empty.
+        if chunk.count(b"\0") == len(chunk):
+            continue
+        run_start = None
+        for offset in xrange(0, len(chunk), PAGE_SIZE):
+            if chunk[offset:offset + PAGE_SIZE] == _ZERO_PAGE:
+                if run_start is not None:
+                    yield chunk_start + run_start, chunk_start + offset
+                    run_start = None
+            elif run_start is None:
+                run_start = offset
+        if run_start is not None:
+            yield chunk_start + run_start, chunk_start + len(chunk)
+
+
+class _PageRanges(object):
+    """
+    The pages that were already written to a page blob, as returned by `get_page_ranges`.
+    """
+
+    def __init__(self, page_ranges=()):
+        # Azure returns sorted, non-overlapping ranges, with an inclusive end.
+        self._ranges = [(int(page_range.start), int(page_range.end) + 1) for page_range in page_ranges]
+        self._starts = [start for start, _ in self._ranges]
+
+    def __contains__(self, page_range):
+        start, end = page_range
+        i = bisect.bisect_right(self._starts, start) - 1
+        return i >= 0 and self._ranges[i][1] >= end
+
+
+def source_fingerprint(path):
+    """
+    Identifies the contents of a local VHD without reading all of it: its size, its modification time, and its footer
+    (the last page, which holds the disk's unique id).
+    """
+    stat = os.stat(path)
+    fingerprint = hashlib.sha1("{0}:{1!r}:".format(stat.st_size, stat.st_mtime).encode("ascii"))
+    with open(path, "rb") as f:
+        f.seek(max(0, stat.st_size - PAGE_SIZE))
+        fingerprint.update(f.read(PAGE_SIZE))
+    return fingerprint.hexdigest()
+
+
+def upload_image(sms, bs, tracker, container_name, path, image_name, os_type, label=None, concurrency=16):
+    """
+    Upload a local (fixed-size) VHD as a page blob, skipping the pages that are all zeroes, and register it as an OS
+    Image. If a previous upload of the same VHD was interrupted, only the pages it didn't get to are uploaded.
+    Returns the upload's CopyStats once the Image is registered.
+    """
+    resumed = journal.resume(tracker, "upload", image_name)
+    if resumed is not None:
+        resumed.result()
+        step = journal.get("upload", image_name)
+        return CopyStats(step["blob"], step["size"], step["duration"])
+
+    started_at = time.time()
+    blob_name = "{0}{1}.vhd".format(UPLOADED_BLOB_PREFIX, image_name)
+    blob_url = bs.make_blob_url(container_name, blob_name)
+    size = os.path.getsize(path)
+    if not size or size % PAGE_SIZE:
+        raise ValueError("'{0}' is not a fixed-size VHD: its size must be a multiple of {1} bytes".format(path, PAGE_SIZE))
+
+    # Pick up where a previous upload left off, if there's one (of the same file: VHDs of the same image family all
+    # have the same size). The blob's size is set when it's created, and can't tell us which pages were written: the
+    # page ranges can.
+    fingerprint = source_fingerprint(path)
     try:
-        service = sms.get_hosted_service_properties(service_name, embed_detail = True)
+        properties = bs.get_blob_properties(container_name, blob_name)
     except WindowsAzureMissingResourceError:
-        logger.info("Service '%s' was already deleted", service_name)
-        return
+        properties = None
+    # Header names keep the case the server sent them in.
+    headers = dict((name.lower(), value) for name, value in properties.items()) if properties is not None else {}
+    if headers.get("x-ms-meta-source_fingerprint") == fingerprint:
+        uploaded = _PageRanges(bs.get_page_ranges(container_name, blob_name))
+        logger.info("Resuming the upload of '%s' to '%s'", path, blob_name)
+    else:
+        if properties is not None:
+            logger.info("'%s' was uploaded from another file: starting over", blob_name)
+        # This replaces the blob (and its pages) if there's one.
+        bs.put_blob(container_name, blob_name, None, "PageBlob", x_ms_blob_content_length=size,
+                    x_ms_meta_name_values={"source_fingerprint": fingerprint})
+        uploaded = _PageRanges()
+        logger.info("Uploading '%s' to '%s' (%.1f GB)", path, blob_name, size / 2.0 ** 30)
+
+    counts = collections.Counter()
+    errors = []
+    # Bounds how many pages are read ahead of the uploads.
+    in_flight = threading.BoundedSemaphore(concurrency * 2)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def put_page(start, end):
+        # Slicing the mmap reads the range straight from the file (or the page cache).
+        bs.put_page(container_name, blob_name, data[start:end], "bytes={0}-{1}".format(start, end - 1), "update")
+
+    def on_done(future, length):
+        in_flight.release()
+        if future.exception() is not None:
+            errors.append(future.exception())
+        else:
+            counts["uploaded"] += length
+
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start, end in nonzero_ranges(data, size):
+                if errors:
+                    break
+                if (start, end) in uploaded:
+                    counts["skipped"] += end - start
+                    continue
+                in_flight.acquire()
+                future = executor.submit(put_page, start, end)
+                future.add_done_callback(lambda future, length=end - start: on_done(future, length))
+            executor.shutdown(wait=True)
+        finally:
+            data.close()
+
+    if errors:
+        raise errors[0]
+
+    duration = time.time() - started_at
+    logger.info("Uploaded %.0f MB out of %.0f MB in %.0fs (%.1f MB/s). %.0f MB were already uploaded, and the rest is "
+                "empty", counts["uploaded"] / 2.0 ** 20, size / 2.0 ** 20, duration,
+                counts["uploaded"] / 2.0 ** 20 / max(duration, 1e-3), counts["skipped"] / 2.0 ** 20)
+
+    op = sms.add_os_image(label or image_name, blob_url, image_name, os_type)
+    journal.track(tracker, "upload", image_name, op, _log_created_image(image_name), blob=blob_name, size=size,
+                  duration=duration).result()
+    return CopyStats(blob_name, size, duration)
+
+
+######################
+# Garbage Collection #
+######################
+# Deleting a VM leaves its Disks behind, and their VHDs stay behind if deleting the Disks fails (or the run is
+# interrupted first). So does a snapshot's copy if its Image never gets registered. Nothing references those blobs
+# anymore, but we keep paying for their storage. Any page blob in the VHDs and Images containers that isn't the VHD of
+# a registered Disk or OS Image is garbage.
+
+# Blobs that were written recently may be about to be registered (e.g. an upload or a copy that just completed).
+GC_MIN_AGE = 60 * 60
+
+
+def _blob_key(url):
+    # Disks and Images may refer to their VHD with a different scheme, host name case, or escaping than we do.
+    parsed = urlparse.urlparse(url)
+    return parsed.netloc.lower(), urllib.unquote(parsed.path)
+
+
+def _modified_at(properties):
+    parsed = email.utils.parsedate_tz(properties.last_modified or "")
+    # When in doubt, assume the blob was just written.
+    return email.utils.mktime_tz(parsed) if parsed else time.time()
+
+
+def collect_garbage(sms, bs, container_names, dry_run=False, min_age=GC_MIN_AGE, concurrency=16):
+    """
+    Delete the page blobs in the containers that aren't the VHD of any registered Disk or OS Image. Blobs that are
+    leased (i.e. attached to a VM), being copied to, or that were written in the last `min_age` seconds are left alone.
+    With `dry_run`, only report what would be deleted. Returns the number of blobs and bytes reclaimed (or that would
+    be).
+    """
+    started_at = time.time()
+
+    # This is done before listing the blobs, so that no blob can get registered behind our back (it would have to be
+    # older than `min_age` and unleased).
+    referenced = set(_blob_key(disk.media_link) for disk in sms.list_disks() if disk.media_link)
+    referenced.update(_blob_key(image.media_link) for image in sms.list_os_images() if image.media_link)
+
+    counts = collections.Counter()
+    errors = []
+    # Bounds how many deletions are queued ahead of the executor while we go through the listing.
+    in_flight = threading.BoundedSemaphore(concurrency * 2)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def delete(container_name, blob_name):
+        try:
+            bs.delete_blob(container_name, blob_name)
+        except WindowsAzureMissingResourceError:
+            logger.info("Blob '%s/%s' was already deleted", container_name, blob_name)
+            return False
+        except WindowsAzureConflictError as e:
+            # A VM got a lease on it since we listed it.
+            logger.warning("Blob '%s/%s' could not be deleted: %s", container_name, blob_name, e)
+            return False
+        return True
+
+    def on_done(future, container_name, blob_name, size):
+        in_flight.release()
+        if future.exception() is not None:
+            logger.error("Failed to delete blob '%s/%s': %s", container_name, blob_name, future.exception())
+            errors.append(future.exception())
+        elif future.result():
+            counts["deleted"] += 1
+            counts["deleted_bytes"] += size
 
-    for deployment in service.deployments:
-        disks_to_delete = []
-
-        # Deleting a Deployment (or deleting VMs, for that matter) will not delete the Disks associated with them,
-        # so we start by getting a list of the Disks we'll need to cleanup.
-        for role in deployment.role_list:
-            disks_to_delete.append(role.os_virtual_hard_disk)
-            disks_to_delete.extend(role.data_virtual_hard_disks)
-            # Note that we shouldn't try to also delete the VMs here. This would fail for the last VM because you need
-            # to delete the entire Deployment when deleting the last VM.
-
-        logger.info("Deleting Deployment '%s'", deployment.name)
-        op = sms.delete_deployment(service_name, deployment.name)
-        wait_for_operation(sms, op)
-
-        while disks_to_delete:
-            candidate = disks_to_delete.pop(0)
-
-            if not hasattr(candidate, 'name'):
-                # Disk has a name, but OSVirtualHardDisk has disk_name
-                candidate.name = candidate.disk_name
-
-            if hasattr(candidate, "attached_to"):
-                # We've already seen this guy, it's a real disk. Pace ourselves.
-                logger.debug("Disk '%s' was attached when we checked, waiting", candidate.name)
-                time.sleep(10)
-
-            # Although we waited for the delete operation to complete on the Deployment, Azure actually doesn't guarantee
-            # (though they don't document that anywhere) that our disks will be detached when that operation has completed.
-            # In fact, the disks will always remain attached for a little while after the VM has been deleted. We therefore
-            # poll the disks until they have finally been detached, before attempting to delete them (attempting to delete
-            # an attached disk would of course fail).
-            real_disk = sms.get_disk(candidate.name)
-            if real_disk.attached_to is not None:
-                logger.debug("Disk '%s' is still attached to '%s'", real_disk.name, real_disk.attached_to.role_name)
-                disks_to_delete.append(real_disk)
+    try:
+        for container_name in container_names:
+            try:
+                for blob in iter_blobs(bs, container_name, include="copy"):
+                    properties = blob.properties
+                    if properties.blob_type != "PageBlob":
+                        continue
+                    if _blob_key(bs.make_blob_url(container_name, blob.name)) in referenced:
+                        continue
+
+                    size = int(properties.content_length)
+                    if properties.lease_status == "locked":
+                        counts["leased"] += 1
+                    elif properties.copy_status == "pending":
+                        counts["copying"] += 1
+                    elif _modified_at(properties) > started_at - min_age:
+                        counts["recent"] += 1
+                    elif dry_run:
+                        logger.info("Would delete blob '%s/%s' (%.1f GB)", container_name, blob.name, size / 2.0 ** 30)
+                        counts["deleted"] += 1
+                        counts["deleted_bytes"] += size
+                    else:
+                        logger.info("Deleting blob '%s/%s' (%.1f GB)", container_name, blob.name, size / 2.0 ** 30)
+                        in_flight.acquire()
+                        future = executor.submit(delete, container_name, blob.name)
+                        future.add_done_callback(lambda future, container_name=container_name, blob_name=blob.name,
+                                                 size=size: on_done(future, container_name, blob_name, size))
+            except WindowsAzureMissingResourceError:
+                logger.info("Container '%s' does not exist", container_name)
+    finally:
+        executor.shutdown(wait=True)
+
+    logger.info("%s %s unreferenced blobs (%.1f GB) in %.0fs. Left alone: %s leased, %s being copied to, %s written in "
+                "the last %.0fs", "Found" if dry_run else "Deleted", counts["deleted"],
+                counts["deleted_bytes"] / 2.0 ** 30, time.time() - started_at, counts["leased"], counts["copying"],
+                counts["recent"], min_age)
+
+    if errors:
+        raise errors[0]
+    return counts["deleted"], counts["deleted_bytes"]
+
+
+_END_OF_STREAM = object()
+
+
+def provision_pipeline(sms, bs, tracker, service_name, deployment_name, network_name, vhds_container, n_vms, template,
+                       prober=None, copy_watcher=None, snapshot_config=None, queue_size=8, ssh_workers=8,
+                       deployed_vms=()):
+    """
+    Provision VMs, and push each VM through the later stages (SSH readiness, then snapshot) as soon as it's ready,
+    rather than waiting for the whole cluster to be provisioned first. Stages are connected by bounded queues, so that
+    a slow stage holds provisioning back instead of piling up work.
+
+    SSH readiness is only checked if a `prober` is passed, and VMs are only snapshotted if a `snapshot_config` (and a
+    `copy_watcher`) is. VMs in `deployed_vms` (e.g. VMs deployed by a previous run) go straight to the later stages.
+    """
+    started_at = time.time()
+    errors = []
+
+    ssh_queue = Queue.Queue(queue_size)
+    snapshot_queue = Queue.Queue(queue_size)
+
+    def ready(vm_name):
+        logger.info("VM '%s' is usable after %.1fs", vm_name, time.time() - started_at)
+
+    def ready_when_done(vm_name):
+        def on_done(future):
+            if future.exception() is None:
+                ready(vm_name)
+        return on_done
+
+    def ssh_stage():
+        while 1:
+            vm_name = ssh_queue.get()
+            if vm_name is _END_OF_STREAM:
+                # Let the other workers know, too.
+                ssh_queue.put(_END_OF_STREAM)
+                return
+            try:
+                deployment = sms.get_deployment_by_name(service_name, deployment_name)
+                prober.probe(ssh_targets(deployment, [vm_name]))
+            except Exception as e:
+                logger.error("Failed to check SSH on '%s': %s", vm_name, e)
+                errors.append(e)
+                continue
+            if snapshot_config is not None:
+                snapshot_queue.put(vm_name)
+            else:
+                ready(vm_name)
+
+    def snapshot_stage():
+        image_operations = []
+        while 1:
+            vm_name = snapshot_queue.get()
+            if vm_name is _END_OF_STREAM:
+                break
+            try:
+                deployment = sms.get_deployment_by_name(service_name, deployment_name)
+                instance = [i for i in deployment.role_instance_list if i.role_name == vm_name][0]
+                root_vhd = [r.os_virtual_hard_disk for r in deployment.role_list if r.role_name == vm_name][0]
+                future = snapshot_role(sms, tracker, copy_watcher, snapshot_config, instance, root_vhd)
+            except Exception as e:
+                logger.error("Failed to snapshot '%s': %s", vm_name, e)
+                errors.append(e)
                 continue
+            future.add_done_callback(ready_when_done(vm_name))
+            image_operations.append(future)
+        try:
+            wait_for_all(image_operations)
+        except Exception as e:
+            errors.append(e)
+
+    def spawn(target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    ssh_threads = []
+    snapshot_thread = None
+    if prober is not None:
+        ssh_threads = [spawn(ssh_stage, "pipeline-ssh-{0}".format(i)) for i in range(ssh_workers)]
+    if snapshot_config is not None:
+        snapshot_thread = spawn(snapshot_stage, "pipeline-snapshot")
+
+    # The first stage (provisioning) runs in this thread.
+    def deployed(vm_name):
+        if ssh_threads:
+            ssh_queue.put(vm_name)
+        elif snapshot_thread is not None:
+            snapshot_queue.put(vm_name)
+        else:
+            ready(vm_name)
 
-            # Disk is no longer attached; we can finally delete. We make sure to also delete the underlying VHD (i.e. the blob
-            # in Azure storage)
-            logger.info("Deleting Disk '%s'", real_disk.name)
-            sms.delete_disk(real_disk.name, delete_vhd=True)
+    port_allocator = PortAllocator.for_deployment(sms, service_name, deployment_name)
+    try:
+        for vm_name in deployed_vms:
+            deployed(vm_name)
+        add_vms(sms, bs, tracker, service_name, deployment_name, network_name, vhds_container, template, n_vms,
+                port_allocator, on_added=deployed)
+    finally:
+        # Shut the stages down in order, letting them finish the VMs they were already given.
+        if ssh_threads:
+            ssh_queue.put(_END_OF_STREAM)
+            for thread in ssh_threads:
+                thread.join()
+        if snapshot_thread is not None:
+            snapshot_queue.put(_END_OF_STREAM)
+            snapshot_thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def start(sms, tracker, service_name, deployment_name):
+    key = "{0}/{1}".format(service_name, deployment_name)
+    resumed = journal.resume(tracker, "start", key)
+    if resumed is not None:
+        return resumed
 
+    logger.info("Starting all Roles in '%s/%s'", service_name, deployment_name)
+    deployment = sms.get_deployment_by_name(service_name, deployment_name)
+    op = sms.start_roles(service_name, deployment_name, [role.role_name for role in deployment.role_list])
+    return journal.track(tracker, "start", key, op, service_name=service_name, deployment_name=deployment_name)
 
-    logger.info("Deleting Service '%s'", service_name)
-    sms.delete_hosted_service(service_name)
 
+def stop(sms, tracker, service_name, deployment_name):
+    key = "{0}/{1}".format(service_name, deployment_name)
+    resumed = journal.resume(tracker, "stop", key)
+    if resumed is not None:
+        return resumed
 
-def snapshot(sms, bs, service_name, deployment_name, images_container, snapshot_config):
-    # Ensure that the Images container exists
-    bs.create_container(images_container, fail_on_exist=False)
+    logger.info("Stopping all Roles in '%s/%s'", service_name, deployment_name)
+    deployment = sms.get_deployment_by_name(service_name, deployment_name)
 
+    # Here, Azure gives us the option to shutdown and stop paying for the instance (StoppedDeallocated), or just to
+    # shut down and continue paying. It's unclear what are the benefits of continuing to pay (maybe the VM boots
+    # up faster next time, and maybe the IP is retained). For demonstration purposes, we de-allocate the VM.
+    op = sms.shutdown_roles(service_name, deployment_name, [role.role_name for role in deployment.role_list],
+                            post_shutdown_action="StoppedDeallocated")
+    return journal.track(tracker, "stop", key, op, service_name=service_name, deployment_name=deployment_name)
 
-    # This is where things get really weird. We have two lists: one that contains root volumes, and
-    # one that contains instance states!
-    deployment = sms.get_deployment_by_name(service_name, deployment_name)
-    role_names_to_vhds = dict(((role.role_name, role.os_virtual_hard_disk) for role in deployment.role_list))
 
-    for role in deployment.role_instance_list:
-        logger.info("Preparing to snapshot '%s'. Make you sure you ran `waagent --deallocate`!", role.role_name)
 
-        if role.instance_status not in ("Stopped", "StoppedDeallocated"):
-            logger.warning("Role '%s' is in '%s' state. Snapshotting is risky!", role.role_name, role.instance_status)
+################
+# Plan / Apply #
+################
+# Rather than always adding VMs, we can compare what the VM configuration asks for with what actually exists, and
+# only do what's needed to converge.
 
-        # TODO - Lease problem here? Seems like there isn't.
-        root_vhd = role_names_to_vhds[role.role_name]
+STOPPED_STATUSES = ("Stopped", "StoppedVM", "StoppedDeallocated")
 
-        dst_blob_name = "image-from-{0}.vhd".format(role.role_name)
-        dst_blob_url = bs.make_blob_url(images_container, dst_blob_name)
-        bs.copy_blob(images_container, dst_blob_name, root_vhd.media_link)
+PlanStep = collections.namedtuple("PlanStep", ["action", "service_name", "deployment_name", "count", "role_names", "reason"])
 
 
-        format_kwargs = {"role": role}
-        os_label = snapshot_config.label_tpl.format(**format_kwargs)
-        os_name = snapshot_config.name_tpl.format(**format_kwargs)
-        os_type = snapshot_config.os
+def _desired_endpoints(vm_config):
+    return sorted((nat_port.name, nat_port.protocol.lower(), int(nat_port.port), bool(nat_port.lb))
+                  for nat_port in vm_config.net.nat_ports)
 
-        op = sms.add_os_image(os_label, dst_blob_url, os_name, os_type)
-        wait_for_operation(sms, op)
 
-        logger.info("Created OS: '%s'", os_name)
+def _actual_endpoints(role):
+    endpoints = []
+    for configuration_set in role.configuration_sets:
+        if configuration_set.configuration_set_type != "NetworkConfiguration":
+            continue
+        for endpoint in configuration_set.input_endpoints:
+            endpoints.append((endpoint.name, endpoint.protocol.lower(), int(endpoint.local_port),
+                              bool(endpoint.load_balanced_endpoint_set_name)))
+    return sorted(endpoints)
 
 
-def start(sms, service_name, deployment_name):
-    logger.info("Starting all Roles in '%s/%s'", service_name, deployment_name)
-    deployment = sms.get_deployment_by_name(service_name, deployment_name)
-    op = sms.start_roles(service_name, deployment_name, [role.role_name for role in deployment.role_list])
-    wait_for_operation(sms, op)
+def role_drift(role, vm_config):
+    """
+    Returns why the role doesn't match the VM configuration, or None if it does.
+    """
+    if role.role_size != vm_config.size:
+        return "size is '{0}', not '{1}'".format(role.role_size, vm_config.size)
 
+    if _actual_endpoints(role) != _desired_endpoints(vm_config):
+        return "endpoints don't match"
 
-def stop(sms, service_name, deployment_name):
-    logger.info("Stopping all Roles in '%s/%s'", service_name, deployment_name)
-    deployment = sms.get_deployment_by_name(service_name, deployment_name)
+    actual_disks = [int(disk.logical_disk_size_in_gb) for disk in sorted(role.data_virtual_hard_disks, key=lambda d: int(d.lun))]
+    desired_disks = [int(disk_config.size_gb) for disk_config in vm_config.data_disks]
+    if actual_disks != desired_disks:
+        return "data disks are {0} GB, not {1} GB".format(actual_disks, desired_disks)
 
-    # Here, Azure gives us the option to shutdown and stop paying for the instance (StoppedDeallocated), or just to
-    # shut down and continue paying. It's unclear what are the benefits of continuing to pay (maybe the VM boots
-    # up faster next time, and maybe the IP is retained). For demonstration purposes, we de-allocate the VM.
-    op = sms.shutdown_roles(service_name, deployment_name, [role.role_name for role in deployment.role_list],
-                            post_shutdown_action="StoppedDeallocated")
-    wait_for_operation(sms, op)
+    return None
 
 
+def plan(deployment, service_name, deployment_name, n_vms, vm_config):
+    """
+    Compute (locally) the steps needed for `deployment` (which may be None if it doesn't exist) to have `n_vms` VMs
+    matching `vm_config`. VMs are expected to be running, unless `vm_config.state` is "stopped".
+    """
+    steps = []
 
-def main():
-    #################
-    # Configuration #
-    #################
+    def step(action, count=0, role_names=(), reason=""):
+        steps.append(PlanStep(action, service_name, deployment_name, count, list(role_names), reason))
+
+    roles = deployment.role_list if deployment is not None else []
+    statuses = dict((instance.role_name, instance.instance_status)
+                    for instance in (deployment.role_instance_list if deployment is not None else []))
 
+    keep = []
+    for role in roles:
+        drift = role_drift(role, vm_config)
+        if drift is not None:
+            step("remove", 1, [role.role_name], drift)
+        else:
+            keep.append(role.role_name)
+
+    if len(keep) > n_vms:
+        # Get rid of VMs that aren't running first.
+        keep.sort(key=lambda role_name: statuses.get(role_name) not in STOPPED_STATUSES)
+        extra, keep = keep[:len(keep) - n_vms], keep[len(keep) - n_vms:]
+        step("remove", len(extra), extra, "there are more than {0} VMs".format(n_vms))
+
+    if vm_config.get("state", "running") == "stopped":
+        to_stop = [role_name for role_name in keep if statuses.get(role_name) not in STOPPED_STATUSES]
+        if to_stop:
+            step("stop", len(to_stop), to_stop, "VMs should be stopped")
+    else:
+        to_start = [role_name for role_name in keep if statuses.get(role_name) in STOPPED_STATUSES]
+        if to_start:
+            step("start", len(to_start), to_start, "VMs should be running")
+
+    if len(keep) < n_vms:
+        reason = "there are fewer than {0} VMs".format(n_vms)
+        if vm_config.get("state", "running") == "stopped":
+            # New VMs come up running: they're stopped once they've all been added.
+            reason += ", and they should be stopped"
+        step("add", n_vms - len(keep), reason=reason)
+
+    return steps
+
+
+def log_plan(steps):
+    if not steps:
+        logger.info("Plan: nothing to do")
+    for step in steps:
+        logger.info("Plan: %s %s VM(s) in '%s/%s' (%s)%s", step.action, step.count, step.service_name,
+                    step.deployment_name, step.reason, ": " + ", ".join(step.role_names) if step.role_names else "")
+
+
+def apply_plan(sms, bs, tracker, deployment, steps, network_name, vhds_container, template):
+    """
+    Apply the steps computed by `plan` for a single Deployment.
+    """
+    reaper = DiskReaper(sms)
+    roles = dict((role.role_name, role) for role in (deployment.role_list if deployment is not None else []))
+
+    to_remove = [role_name for step in steps if step.action == "remove" for role_name in step.role_names]
+    if to_remove:
+        service_name, deployment_name = steps[0].service_name, steps[0].deployment_name
+
+        # You can't delete the last VM of a Deployment: the Deployment has to go instead.
+        delete_deployment = len(to_remove) == len(roles)
+        for role_names in [to_remove] if delete_deployment else [[role_name] for role_name in to_remove]:
+            # Each operation must be tracked as soon as it's issued: the scheduler holds the next one back until the
+            # previous one completes.
+            disk_names = []
+            for role_name in role_names:
+                disk_names.append(roles[role_name].os_virtual_hard_disk.disk_name)
+                disk_names.extend(disk.disk_name for disk in roles[role_name].data_virtual_hard_disks)
+            if delete_deployment:
+                logger.info("Deleting Deployment '%s'", deployment_name)
+                op = sms.delete_deployment(service_name, deployment_name)
+                kind, key = "delete_deployment", "{0}/{1}".format(service_name, deployment_name)
+            else:
+                op = sms.delete_role(service_name, deployment_name, role_names[0])
+                kind, key = "delete_role", role_names[0]
+            future = journal.track(tracker, kind, key, op, service_name=service_name, deployment_name=deployment_name,
+                                   disks=disk_names)
+            reaper.add_after(future, disk_names)
+            # Azure only runs one Role operation at a time in a given Deployment.
+            future.result()
+
+    for step in steps:
+        key = "{0}/{1}".format(step.service_name, step.deployment_name)
+        if step.action == "start":
+            op = sms.start_roles(step.service_name, step.deployment_name, step.role_names)
+        elif step.action == "stop":
+            op = sms.shutdown_roles(step.service_name, step.deployment_name, step.role_names,
+                                    post_shutdown_action="StoppedDeallocated")
+        else:
+            continue
+        journal.track(tracker, step.action, key, op, service_name=step.service_name,
+                      deployment_name=step.deployment_name).result()
+
+    # Ports used by the VMs we just removed are still considered in use, which is fine.
+    port_allocator = PortAllocator.from_deployment(deployment)
+    for step in steps:
+        if step.action == "add":
+            vm_names = add_vms(sms, bs, tracker, step.service_name, step.deployment_name, network_name, vhds_container,
+                               template, step.count, port_allocator)
+
+            # One operation stops all the new VMs at once. If we don't get to it, the next plan has a stop step.
+            if vm_names and template.vm_config.get("state", "running") == "stopped":
+                deallocate(sms, tracker, step.service_name, step.deployment_name, vm_names)
+
+    # The Disks of the VMs we removed are cleaned up last, since they take a while to be detached.
+    reaper.run()
+
+
+
+#############
+# Warm pool #
+#############
+# Provisioning a VM (copying its image, creating its Disks, and its first boot) takes minutes. Instead, we can keep a
+# pool of VMs that were provisioned ahead of time and then deallocated (so we don't pay for them while they wait):
+# handing one out only takes starting it and waiting for SSH. VMs that are StoppedDeallocated are the pool; any other
+# VM has been handed out (stopping it with `--stop` puts it back).
+#
+# A VM still looks StoppedDeallocated for a little while after it was handed out (it takes a while to start), so
+# concurrent acquisitions (from separate invocations) would hand it out again. Acquisitions claim the VMs they pick in a
+# file they lock, and skip the VMs that were claimed.
+#
+# Adding a VM holds its Deployment for minutes, and starting VMs in a busy Deployment has to wait for that. A refill adds
+# VMs to one shard at a time, and lets acquisitions know which one, so that they can start VMs in the other shards.
+
+def pooled_vms(deployment):
+    if deployment is None:
+        return []
+    return sorted(instance.role_name for instance in deployment.role_instance_list
+                  if instance.instance_status == "StoppedDeallocated")
+
+
+def _get_deployment_or_none(sms, service_name, deployment_name):
+    try:
+        return sms.get_deployment_by_name(service_name, deployment_name)
+    except WindowsAzureMissingResourceError:
+        return None
+
+
+class PoolClaims(object):
+    """
+    The VMs that were taken out of the pool recently, kept in a file (shared by all the invocations that use the same
+    configuration) along with when they were claimed. A claim lasts for `ttl` seconds, by which time the VM no longer
+    looks StoppedDeallocated (if it's been put back in the pool since, it's only available again then).
+    """
+
+    def __init__(self, path, ttl=15 * 60):
+        self.path = path
+        self.ttl = ttl
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Yields the claims (VM name -> time claimed), which the block may change. No one else gets to read or change them
+        until the block exits.
+        """
+        with open(self.path, "a+") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                expired_at = time.time() - self.ttl
+                claims = dict((name, claimed_at) for name, claimed_at in (json.loads(content) if content else {}).items()
+                              if claimed_at > expired_at)
+                yield claims
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(claims))
+                f.flush()
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def unclaimed(self, pools):
+        """
+        Returns the pools (shard -> VM names) without the VMs that were claimed.
+        """
+        with self.locked() as claims:
+            return _unclaimed(claims, pools)
+
+    def set_refilling(self, shard):
+        """
+        Record that VMs are being added to `shard` (or that none are, if it's None). The record lasts for `ttl`
+        seconds, in case the refill dies before it clears it.
+        """
+        with self.locked() as claims:
+            for key in [key for key in claims if key.startswith(_REFILLING)]:
+                del claims[key]
+            if shard is not None:
+                claims[_REFILLING + "/".join(shard)] = time.time()
+
+    def refilling(self):
+        """
+        Returns the shard that VMs are being added to, or None.
+        """
+        with self.locked() as claims:
+            return _refilling(claims)
+
+
+# The shard being refilled is recorded along with the claims, under a key that can't be a VM name.
+_REFILLING = "refilling:"
+
+
+def _unclaimed(claims, pools):
+    return dict((shard, [name for name in role_names if name not in claims]) for shard, role_names in pools.items())
+
+
+def _refilling(claims):
+    for key in claims:
+        if key.startswith(_REFILLING):
+            return tuple(key[len(_REFILLING):].split("/", 1))
+    return None
+
+
+def acquire(sms, tracker, shards, n_vms, claims):
+    """
+    Take `n_vms` VMs out of the pool, and start them. Returns their SSH targets (there may be fewer VMs than `n_vms` if
+    the pool runs dry): it's up to the caller to wait for SSH. The VMs are claimed in `claims` (PoolClaims), so that
+    concurrent acquisitions don't pick them too.
+
+    VMs in the shard that's being refilled are only picked if the other shards run out: starting them waits for the VM
+    being added to that shard.
+    """
+    pools = dict((shard, pooled_vms(_get_deployment_or_none(sms, *shard))) for shard in shards)
+
+    picked = collections.defaultdict(list)
+    with claims.locked() as claimed:
+        pools = _unclaimed(claimed, pools)
+        refilling = _refilling(claimed)
+
+        # Take VMs from every shard in turn, so that they're all started in parallel.
+        for _ in range(n_vms):
+            shard = max(shards, key=lambda shard: (shard != refilling and bool(pools[shard]), len(pools[shard])))
+            if not pools[shard]:
+                logger.warning("Only %s VMs were left in the pool (out of %s requested)",
+                               sum(len(role_names) for role_names in picked.values()), n_vms)
+                break
+            name = pools[shard].pop(0)
+            picked[shard].append(name)
+            claimed[name] = time.time()
+
+    def start_picked(service_name, deployment_name):
+        role_names = picked[(service_name, deployment_name)]
+        if not role_names:
+            return []
+        logger.info("Acquiring %s VMs from the pool in '%s/%s': %s", len(role_names), service_name, deployment_name,
+                    ", ".join(role_names))
+        tracker.track(sms.start_roles(service_name, deployment_name, role_names), label=deployment_name).result()
+        # Public IPs are only assigned once the VMs are started.
+        return ssh_targets(sms.get_deployment_by_name(service_name, deployment_name), role_names)
+
+    return [target for shard_targets in for_each_shard(shards, start_picked) for target in shard_targets]
+
+
+def refill_pool(sms, bs, tracker, config, shards, template, claims, prober=None):
+    """
+    Add VMs to the pool until it has `config.pool_size` VMs (not counting the VMs claimed in `claims`, which are being
+    handed out). New VMs go through their first boot (we wait for SSH if a `prober` is passed) before they're
+    deallocated, so that starting them later is as fast as can be.
+
+    Shards are refilled one at a time (the emptiest first), and the shard being refilled is recorded in `claims`, so
+    that acquisitions meanwhile start VMs in Deployments that aren't busy adding VMs.
+    """
+    shard_pool_sizes = dict(zip(shards, split_vms(config.pool_size, len(shards))))
+    deployments = dict((shard, _get_deployment_or_none(sms, *shard)) for shard in shards)
+    pools = claims.unclaimed(dict((shard, pooled_vms(deployment)) for shard, deployment in deployments.items()))
+
+    def refill(service_name, deployment_name):
+        create_hosted_service(sms, service_name, config.service_location)
+        deployment = deployments[(service_name, deployment_name)]
+        n_vms = shard_pool_sizes[(service_name, deployment_name)] - len(pools[(service_name, deployment_name)])
+        if n_vms <= 0:
+            return
+        logger.info("Adding %s VMs to the pool in '%s/%s'", n_vms, service_name, deployment_name)
+
+        claims.set_refilling((service_name, deployment_name))
+        vm_names = add_vms(sms, bs, tracker, service_name, deployment_name, config.network_name, config.containers.vhds,
+                           template, n_vms, PortAllocator.from_deployment(deployment),
+                           # This also keeps the record from expiring while we work through the shard.
+                           on_added=lambda _: claims.set_refilling((service_name, deployment_name)))
+
+        if prober is not None:
+            prober.probe(ssh_targets(sms.get_deployment_by_name(service_name, deployment_name), vm_names))
+
+        # One operation deallocates all the new VMs at once.
+        deallocate(sms, tracker, service_name, deployment_name, vm_names)
+        logger.info("Added %s VMs to the pool in '%s/%s'", len(vm_names), service_name, deployment_name)
+
+    try:
+        for shard in sorted(shards, key=lambda shard: len(pools[shard]) - shard_pool_sizes[shard]):
+            refill(*shard)
+    finally:
+        claims.set_refilling(None)
+
+
+@contextlib.contextmanager
+def refill_lock(path):
+    """
+    Yields True if we got to hold the lock on `path` (until the block exits), or False if someone else holds it: a
+    refill that overlaps with another one would add too many VMs.
+    """
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# The daemon changes directories for every command.
+_SCRIPT_PATH = os.path.abspath(__file__)
+
+
+def spawn_refill(config_path, pool_vm_config_path, log_path):
+    """
+    Refill the pool in a separate invocation of this script, which outlives this one (and doesn't hold up the daemon),
+    and logs to `log_path`.
+    """
+    argv = [sys.executable, _SCRIPT_PATH, "--config", os.path.abspath(config_path),
+            "--refill-pool", os.path.abspath(pool_vm_config_path)]
+    logger.info("Refilling the pool in the background (see '%s')", log_path)
+    with open(os.devnull) as devnull, open(log_path, "a") as log:
+        # In a session of its own, so that it isn't interrupted along with us.
+        subprocess.Popen(argv, stdin=devnull, stdout=log, stderr=log, close_fds=True, preexec_fn=os.setsid)
+
+
+def setup_services(sms, bs, config, poll_interval=0.5, max_poll_interval=10):
+    """
+    Wrap the Service Management and Blob services for use by the rest of this script, and create the tracker for the
+    asynchronous operations. Returns (sms, bs, tracker).
+    """
+    # All the API calls go through schedulers that rate-limit them and retry transient errors (the Subscription
+    # and the Storage Account have limits of their own).
+    sms_scheduler = RequestScheduler(rate=config.service_management.get("requests_per_second", 10))
+    bs_scheduler = RequestScheduler(rate=config.storage.get("requests_per_second", 50), burst=100)
+    sms = sms_scheduler.wrap(sms)
+    bs = bs_scheduler.wrap(bs)
+
+    # We read the same Hosted Services and Deployments over and over again, so we cache them.
+    sms = ResourceCache(sms)
+
+    # All the asynchronous operations we issue are polled by the tracker. The cache and the scheduler need to know
+    # when they complete (and the scheduler uses it to wait out the operations others run on our Deployments).
+    tracker = OperationTracker(sms, initial_interval=poll_interval, max_interval=max_poll_interval)
+    tracker.add_listener(sms.operation_completed)
+    tracker.add_listener(sms_scheduler.operation_completed)
+    sms_scheduler.tracker = tracker
+
+    return sms, bs, tracker
+
+
+def dry_run(bs, config, shards, template):
+    """
+    Print the payloads of the API calls that would create the VMs of the cluster, as JSON lines. Public ports are
+    allocated as if the Deployments were empty.
+    """
+    for (service_name, deployment_name), n_vms in zip(shards, split_vms(config.n_vms, len(shards))):
+        payloads = template.render([random_vm_name() for _ in range(n_vms)], PortAllocator(),
+                                   lambda blob_name: bs.make_blob_url(config.containers.vhds, blob_name))
+        for payload in payloads:
+            print(json.dumps(dict(payload_to_dict(payload), service_name=service_name, deployment_name=deployment_name),
+                             sort_keys=True))
+
+
+def provision_cluster(sms, bs, tracker, config, shards, template, pipelined=False, prober=None, copy_watcher=None,
+                      snapshot_config=None):
+    # Each shard is provisioned in parallel with the others.
+    shard_n_vms = dict(zip(shards, split_vms(config.n_vms, len(shards))))
+
+    def provision(service_name, deployment_name):
+        create_hosted_service(sms, service_name, config.service_location)
+
+        # If we're resuming a run, some of the VMs may be there already.
+        deployed = resume_deploys(sms, tracker, service_name, deployment_name)
+        n_vms = max(0, shard_n_vms[(service_name, deployment_name)] - len(deployed))
+
+        if pipelined:
+            # In pipeline mode, the SSH and snapshot steps happen as part of provisioning.
+            provision_pipeline(sms, bs, tracker, service_name, deployment_name, config.network_name,
+                               config.containers.vhds, n_vms, template, prober=prober, copy_watcher=copy_watcher,
+                               snapshot_config=snapshot_config, deployed_vms=deployed)
+            return
+
+        add_vms(sms, bs, tracker, service_name, deployment_name, config.network_name, config.containers.vhds, template,
+                n_vms, PortAllocator.for_deployment(sms, service_name, deployment_name))
+
+    for_each_shard(shards, provision)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--config", required=True)
+    parser.add_argument("-c", "--config")
     parser.add_argument('--provision', dest="vm_config", help="Provision the VM as specifified in this file.")
+    parser.add_argument('--plan', dest="plan_vm_config",
+                        help="Show what it would take for the cluster to match the VM configuration in this file")
+    parser.add_argument('--apply', dest="apply_vm_config",
+                        help="Add, remove, start or stop VMs so that the cluster matches the VM configuration in this file")
     parser.add_argument('--start', action='store_true', help="Start all the VMs")
     parser.add_argument('--test-ssh', action='store_true', help="Test SSH on the VMs")
+    parser.add_argument('--ssh-concurrency', type=int, default=64, help="How many SSH connections to attempt at once")
+    parser.add_argument('--ssh-timeout', type=float, default=5, help="How long to wait for SSH to respond")
     parser.add_argument('--stop', action='store_true', help="Stop all the VMs")
     parser.add_argument('--snapshot', dest="snapshot_config", help="Snapshot all the VMs")
     parser.add_argument('--teardown', action='store_true', help="Teardown the cluster (note: OS Images aren't deleted)")
-    ns = parser.parse_args()
-
-    # Those keys MUST be in the configuration file
-    config = attrdict_load(ns.config)
-
-    ###################
-    # Actual Workflow #
-    ###################
-
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Test SSH on / snapshot each VM as soon as it's provisioned, instead of waiting for all VMs")
+    parser.add_argument('--trace', help="Record where the time goes (API calls, polls, SSH attempts) to this file, "
+                                        "in the Chrome trace format")
+    parser.add_argument('--upload-image', dest="image_path",
+                        help="Upload this (fixed-size) VHD, and register it as an OS Image")
+    parser.add_argument('--image-name', help="Name of the OS Image to register the VHD as (defaults to the file name)")
+    parser.add_argument('--image-label', help="Label of the OS Image (defaults to its name)")
+    parser.add_argument('--image-os', default="Linux", help="OS of the uploaded VHD (Linux or Windows)")
+    parser.add_argument('--upload-concurrency', type=int, default=16, help="How many pages to upload at once")
+    parser.add_argument('--acquire', type=int, metavar="N",
+                        help="Take N VMs out of the warm pool, start them, and wait for SSH")
+    parser.add_argument('--refill-pool', dest="pool_vm_config",
+                        help="Provision VMs as specified in this file until the warm pool has `pool_size` VMs "
+                             "(in the background when acquiring VMs)")
+    parser.add_argument('--journal', help="Record the operations issued to this file, so that if the run is "
+                                          "interrupted, running the same command again resumes it")
+    parser.add_argument('--gc', action='store_true',
+                        help="Delete the VHDs in the VHDs and Images containers that no Disk or OS Image uses")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="With --provision: print the payloads of the API calls that would create the VMs (as JSON "
+                             "lines), without making any API call. With --gc: only report the VHDs it would delete")
+    parser.add_argument('--serve', metavar="SOCKET",
+                        help="Run as a daemon that runs commands sent to this Unix socket (see --daemon)")
+    parser.add_argument('--daemon', metavar="SOCKET",
+                        help="Run the command in the daemon listening on this Unix socket (if there's one), which "
+                             "reuses its connections to Azure and its parsed configuration")
+    ns = parser.parse_args(argv)
+    if not ns.config and not ns.serve:
+        parser.error("argument -c/--config is required")
+    if ns.dry_run and not (ns.vm_config or ns.gc):
+        parser.error("argument --dry-run requires --provision or --gc")
+    return ns
+
+
+def connect(config):
+    """
+    Create the Service Management and Blob services for a configuration (see `setup_services`). Returns
+    (sms, bs, tracker).
+    """
     # Service Management is for VMs. Storage Service is for blobs (VHDs that back the VMs). The credentials
     # use by each service are different.
-    sms = ServiceManagementService(config.service_management.subscription_id, config.service_management.certificate_path)
-    bs = BlobService(config.storage.account, config.storage.access_key)
+    certificate_path = config.service_management.certificate_path
+    sms_session = make_session(config.service_management.get("connection_pool_size", 32), cert=certificate_path)
+    sms = make_thread_safe(ServiceManagementService(config.service_management.subscription_id, certificate_path,
+                                                    request_session=sms_session))
+    bs_session = make_session(config.storage.get("connection_pool_size", 32))
+    bs = make_thread_safe(use_session(BlobService(config.storage.account, config.storage.access_key), bs_session))
+    return setup_services(sms, bs, config)
+
+
+def run(ns, config, sms, bs, tracker):
+    # Mistakes in the VM configurations should show up before we make any API call.
+    template = VMTemplate(attrdict_load(ns.vm_config)) if ns.vm_config else None
+    desired_vm_config = ns.apply_vm_config or ns.plan_vm_config
+    desired_template = VMTemplate(attrdict_load(desired_vm_config)) if desired_vm_config else None
+    pool_template = VMTemplate(attrdict_load(ns.pool_vm_config)) if ns.pool_vm_config else None
+
+    if ns.dry_run:
+        if template:
+            dry_run(bs, config, get_shards(config), template)
+        if ns.gc:
+            collect_garbage(sms, bs, sorted(set([config.containers.vhds, config.containers.images])), dry_run=True)
+        return
 
-    if ns.vm_config:
-        create_hosted_service(sms, config.service_name, config.service_location)
+    if ns.trace:
+        tracer.enable()
+    copy_watcher = None
+    try:
+        if ns.journal:
+            journal.open(ns.journal)
+
+        prober = SSHProber(concurrency=ns.ssh_concurrency, timeout=ns.ssh_timeout)
+        snapshot_config = attrdict_load(ns.snapshot_config) if ns.snapshot_config else None
+        if snapshot_config:
+            # Ensure that the Images container exists
+            bs.create_container(config.containers.images, fail_on_exist=False)
+            copy_watcher = BlobCopyWatcher(bs, config.containers.images, prefix=SNAPSHOT_BLOB_PREFIX)
+
+        # In pipeline mode, the SSH and snapshot steps happen as part of provisioning.
+        pipelined = ns.pipeline and ns.vm_config
+
+        shards = get_shards(config)
+
+        # The uploaded Image may be what the VMs get provisioned from, so this goes first.
+        if ns.image_path:
+            with tracer.phase("upload-image"):
+                bs.create_container(config.containers.images, fail_on_exist=False)
+                image_name = ns.image_name or os.path.splitext(os.path.basename(ns.image_path))[0]
+                upload_image(sms, bs, tracker, config.containers.images, ns.image_path, image_name, ns.image_os,
+                             label=ns.image_label, concurrency=ns.upload_concurrency)
+
+        if ns.vm_config:
+            with tracer.phase("provision"):
+                provision_cluster(sms, bs, tracker, config, shards, template, pipelined=pipelined,
+                                  prober=prober if ns.test_ssh else None, copy_watcher=copy_watcher,
+                                  snapshot_config=snapshot_config)
+
+        if desired_template:
+            vm_config = desired_template.vm_config
+            shard_n_vms = dict(zip(shards, split_vms(config.n_vms, len(shards))))
+
+            def converge(service_name, deployment_name):
+                if ns.apply_vm_config:
+                    resume_operations(sms, tracker, service_name, deployment_name)
+
+                # This is the only read we need to compute the plan.
+                try:
+                    deployment = sms.get_deployment_by_name(service_name, deployment_name)
+                except WindowsAzureMissingResourceError:
+                    deployment = None
+
+                steps = plan(deployment, service_name, deployment_name, shard_n_vms[(service_name, deployment_name)],
+                             vm_config)
+                log_plan(steps)
+
+                if ns.apply_vm_config and steps:
+                    create_hosted_service(sms, service_name, config.service_location)
+                    apply_plan(sms, bs, tracker, deployment, steps, config.network_name, config.containers.vhds,
+                               desired_template)
+
+            with tracer.phase("apply" if ns.apply_vm_config else "plan"):
+                for_each_shard(shards, converge)
+
+        # The state of the pool is kept next to the configuration, for all the invocations that use it.
+        claims = PoolClaims(ns.config + ".pool-claims")
+
+        if ns.acquire:
+            with tracer.phase("acquire"):
+                targets = acquire(sms, tracker, shards, ns.acquire, claims)
+                # Refilling the pool takes minutes: when acquiring VMs, it happens in a separate process (once the
+                # acquired VMs were started, so that it doesn't hold them back), and we don't wait for it.
+                if pool_template:
+                    spawn_refill(ns.config, ns.pool_vm_config, ns.config + ".pool-refill.log")
+                time_to_ssh = prober.probe(targets)
+            logger.info("Acquired %s VMs (the slowest was up on SSH after %.1fs)", len(time_to_ssh),
+                        max(time_to_ssh.values()) if time_to_ssh else 0)
+            # This is the output the caller is after.
+            for name, host, port in targets:
+                print("{0} {1} {2}".format(name, host, port))
+
+        if pool_template and not ns.acquire:
+            with tracer.phase("refill-pool"), refill_lock(ns.config + ".pool-refill.lock") as locked:
+                if locked:
+                    refill_pool(sms, bs, tracker, config, shards, pool_template, claims, prober)
+                else:
+                    logger.info("The pool is already being refilled")
+
+        if ns.start:
+            with tracer.phase("start"):
+                wait_for_all([start(sms, tracker, service_name, deployment_name)
+                              for service_name, deployment_name in shards])
+
+        if ns.test_ssh and not pipelined:
+            with tracer.phase("test-ssh"):
+                test_ssh(sms, shards, prober)
+
+        if ns.stop:
+            with tracer.phase("stop"):
+                wait_for_all([stop(sms, tracker, service_name, deployment_name)
+                              for service_name, deployment_name in shards])
+
+        if snapshot_config and not pipelined:
+            with tracer.phase("snapshot"):
+                snapshot(sms, tracker, copy_watcher, shards, snapshot_config)
+
+        if ns.teardown:
+            with tracer.phase("teardown"):
+                teardown(sms, tracker, sorted(set(service_name for service_name, _ in shards)))
+
+        if ns.gc:
+            with tracer.phase("gc"):
+                collect_garbage(sms, bs, sorted(set([config.containers.vhds, config.containers.images])))
+    finally:
+        # The watcher's thread would otherwise outlive a failed command (e.g. in the daemon).
+        if copy_watcher is not None:
+            copy_watcher.close()
+        # The trace of a run that failed midway is the one most worth a look.
+        if ns.trace:
+            tracer.export(ns.trace)
+            tracer.log_summary()
+
+    # We made it to the end: there's nothing left to resume.
+    journal.close(completed=True)
+
+    logger.info("Resource cache: %s hits, %s misses", sms.hits, sms.misses)
+
+
+
+##########
+# Daemon #
+##########
+# Every run has to set up its connections to Azure (TLS handshakes with a client certificate), and parse its
+# configuration, before it gets anything done. A long-lived daemon does it once, and runs the commands of the main.py
+# invocations that pass it `--daemon`, relaying their output back to them.
+
+class _ClientStream(object):
+    """
+    A file-like object that relays what's written to it to a client of the daemon, as JSON lines.
+    """
+
+    def __init__(self, f, name, lock):
+        self._f = f
+        self._name = name
+        self._lock = lock
+
+    def write(self, text):
+        if not text:
+            return
+        with self._lock:
+            self._f.write(json.dumps({self._name: text}) + "\n")
+            self._f.flush()
+
+    def flush(self):
+        pass
+
+
+class Daemon(object):
+    """
+    Runs commands sent over a Unix socket, with services (and their pools of connections) and configurations that are
+    kept from one command to the next. Commands run one at a time, as they would from a shell.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._services = {}  # configuration path -> (mtime, config, sms, bs, tracker)
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The daemon acts with our credentials: nobody else gets to use it.
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        logger.info("Listening for commands on '%s'", self.path)
+
+        try:
+            while 1:
+                connection, _ = server.accept()
+                try:
+                    self._handle(connection)
+                except Exception:
+                    logger.exception("Failed to handle a command")
+                finally:
+                    connection.close()
+        finally:
+            server.close()
+            os.remove(self.path)
+            for _, _, _, _, tracker in self._services.values():
+                tracker.close()
+
+    def services(self, config_path):
+        """
+        Returns (config, sms, bs, tracker) for a configuration file, reusing them unless the file changed.
+        """
+        config_path = os.path.realpath(config_path)
+        mtime = os.path.getmtime(config_path)
+        entry = self._services.get(config_path)
+        if entry is not None and entry[0] == mtime:
+            # Others may have changed the cluster since the last command.
+            entry[2].clear()
+        else:
+            if entry is not None:
+                entry[4].close()
+            config = attrdict_load(config_path)
+            entry = (mtime, config) + connect(config)
+            self._services[config_path] = entry
+        return entry[1:]
+
+    def _handle(self, connection):
+        request = json.loads(connection.makefile("rb").readline())
+        out = connection.makefile("wb")
+        lock = threading.Lock()
+
+        # Everything the command logs or prints goes to the client.
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = _ClientStream(out, "stdout", lock), _ClientStream(out, "stderr", lock)
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        logging.getLogger().addHandler(handler)
+
+        exit_code = 0
+        try:
+            os.chdir(request["cwd"])
+            ns = parse_args(request["argv"])
+            run(ns, *self.services(ns.config))
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            logger.exception("Command failed")
+            exit_code = 1
+        finally:
+            # The command may have failed midway: this leaves the journal behind, to resume from.
+            journal.close()
+            tracer.disable()
+            logging.getLogger().removeHandler(handler)
+            sys.stdout, sys.stderr = stdout, stderr
+
+        out.write(json.dumps({"exit": exit_code}) + "\n")
+        out.flush()
+
+
+def forward_to_daemon(path, argv):
+    """
+    Run a command in the daemon listening on `path`, relaying its output. Returns the command's exit code, or None if
+    there's no daemon listening.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error:
+        connection.close()
+        return None
 
-        vm_config = attrdict_load(ns.vm_config)
-        for _ in range(config.n_vms):
-            deploy_vm(sms, bs, config.service_name, config.deployment_name, config.network_name, config.containers.vhds, vm_config)
+    try:
+        connection.sendall(json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n")
+        for line in connection.makefile("rb"):
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"]
+            for name, stream in (("stdout", sys.stdout), ("stderr", sys.stderr)):
+                if name in message:
+                    stream.write(message[name])
+                    stream.flush()
+        logger.error("The daemon went away before the command completed")
+        return 1
+    finally:
+        connection.close()
 
-    if ns.start:
-        start(sms, config.service_name, config.deployment_name)
 
-    if ns.test_ssh:
-        test_ssh(sms, config.service_name, config.deployment_name)
+def main():
+    ns = parse_args()
 
-    if ns.stop:
-        stop(sms, config.service_name, config.deployment_name)
+    if ns.serve:
+        Daemon(ns.serve).serve_forever()
+        return
 
-    if ns.snapshot_config:
-        snapshot_config = attrdict_load(ns.snapshot_config)
-        snapshot(sms, bs, config.service_name, config.deployment_name, config.containers.images, snapshot_config)
+    if ns.daemon:
+        exit_code = forward_to_daemon(ns.daemon, sys.argv[1:])
+        if exit_code is not None:
+            sys.exit(exit_code)
+        logger.warning("There's no daemon listening on '%s': running the command here", ns.daemon)
 
-    if ns.teardown:
-        teardown(sms, config.service_name)
+    # Those keys MUST be in the configuration file
+    config = attrdict_load(ns.config)
+    sms, bs, tracker = connect(config)
+    try:
+        run(ns, config, sms, bs, tracker)
+    finally:
+        tracker.close()
 
 
 if __name__ == "__main__":
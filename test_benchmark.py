@@ -0,0 +1,24 @@
+#coding:utf-8
+"""
+Runs the benchmark's lifecycle against the fake, on a tiny cluster, as a smoke test of the lifecycle functions.
+"""
+import unittest
+
+import benchmark
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_lifecycle(self):
+        phases, time_to_ready = benchmark.run(2, time_scale=0.002)
+        self.assertEqual([phase.name for phase in phases], ["provision", "test-ssh", "stop", "snapshot", "teardown"])
+        self.assertEqual(len(time_to_ready), 2)
+
+    def test_pipeline(self):
+        phases, time_to_ready = benchmark.run(2, n_shards=2, time_scale=0.002, pipeline=True)
+        self.assertEqual([phase.name for phase in phases], ["provision", "teardown"])
+        self.assertEqual(len(time_to_ready), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
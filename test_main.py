@@ -0,0 +1,283 @@
+#coding:utf-8
+"""
+Unit tests for main.py. The ones that need a Deployment get it from the fake in fake_azure.py.
+
+    python -m pytest
+"""
+import threading
+import unittest
+
+import requests
+from attrdict import AttrDict
+from azure import WindowsAzureError, WindowsAzureConflictError, _general_error_handler
+from azure.http import HTTPError
+from azure.http.httpclient import _HTTPClient
+from azure.servicemanagement import ServiceManagementService
+from azure.storage import PageRange
+
+import benchmark
+import main
+from fake_azure import FakeAzure
+
+
+TIME_SCALE = 0.002
+
+BUSY_BODY = ('<Error xmlns="http://schemas.microsoft.com/windowsazure"><Code>ConflictError</Code><Message>Windows Azure '
+             'is currently performing an operation with x-ms-requestid {0} on this deployment that requires exclusive '
+             'access.</Message></Error>')
+CONFLICT_BODY = ('<Error xmlns="http://schemas.microsoft.com/windowsazure"><Code>ConflictError</Code><Message>A role '
+                 'with this name already exists.</Message></Error>')
+
+
+def sdk_error(status, reason, body, error_filter=lambda e: e):
+    """
+    Returns the error the SDK raises for this response, going through `error_filter` (i.e. our HTTP client) first.
+    """
+    try:
+        _general_error_handler(error_filter(HTTPError(status, reason, [], body)))
+    except WindowsAzureError as e:
+        return e
+
+
+class GetShardsTest(unittest.TestCase):
+
+    def config(self, **shards):
+        config = AttrDict({"service_name": "service", "deployment_name": "deployment"})
+        if shards:
+            config["shards"] = shards
+        return config
+
+    def test_no_shards(self):
+        self.assertEqual(main.get_shards(self.config()), [("service", "deployment")])
+
+    def test_shards(self):
+        config = self.config(count=3, service_name_tpl="service-{shard}", deployment_name_tpl="deployment")
+        self.assertEqual(main.get_shards(config),
+                         [("service-0", "deployment"), ("service-1", "deployment"), ("service-2", "deployment")])
+
+    def test_invalid(self):
+        for count in (0, -1, "2", 1.5):
+            config = self.config(count=count, service_name_tpl="service-{shard}", deployment_name_tpl="deployment")
+            self.assertRaises(ValueError, main.get_shards, config)
+        config = self.config(count=2, service_name_tpl="service", deployment_name_tpl="deployment-{shard}")
+        self.assertRaises(ValueError, main.get_shards, config)
+
+
+class BlobCopyWatcherTest(unittest.TestCase):
+
+    def test_missing_blob(self):
+        azure = FakeAzure(time_scale=TIME_SCALE)
+        azure.bs.create_container("images")
+        watcher = main.BlobCopyWatcher(azure.bs, "images", poll_interval=0.01)
+        try:
+            self.assertRaises(main.OperationFailed, watcher.watch("missing.vhd").result, 5)
+        finally:
+            watcher.close()
+            azure.close()
+
+
+class ResourceCacheTest(unittest.TestCase):
+
+    def test_invalidated_during_read(self):
+        class SMS(object):
+            value = "old"
+            reading = threading.Event()
+            invalidated = threading.Event()
+
+            def get_deployment_by_name(self, service_name, deployment_name):
+                value = self.value
+                self.reading.set()
+                self.invalidated.wait()
+                return value
+
+        sms = SMS()
+        cache = main.ResourceCache(sms)
+        thread = threading.Thread(target=cache.get_deployment_by_name, args=("service", "deployment"))
+        thread.start()
+        sms.reading.wait()
+        sms.value = "new"
+        cache.invalidate("service")
+        sms.invalidated.set()
+        thread.join()
+        self.assertEqual(cache.get_deployment_by_name("service", "deployment"), "new")
+
+
+def vm_config(**overrides):
+    return AttrDict(dict(benchmark.VM_CONFIG, **overrides))
+
+
+class FakeDeploymentTestCase(unittest.TestCase):
+    """
+    Provisions a Deployment of two VMs (from benchmark.VM_CONFIG) in a new fake.
+    """
+
+    def setUp(self):
+        self.azure = FakeAzure(time_scale=TIME_SCALE)
+        self.config = benchmark.make_config(2, 1, TIME_SCALE)
+        self.sms, self.bs, self.tracker = main.setup_services(self.azure.sms, self.azure.bs, self.config,
+                                                              poll_interval=0.5 * TIME_SCALE,
+                                                              max_poll_interval=10 * TIME_SCALE)
+        self.shard = main.get_shards(self.config)[0]
+        main.provision_cluster(self.sms, self.bs, self.tracker, self.config, [self.shard],
+                               main.VMTemplate(benchmark.VM_CONFIG))
+
+    def tearDown(self):
+        self.tracker.close()
+        self.azure.close()
+
+    def deployment(self):
+        return self.azure.sms.get_deployment_by_name(*self.shard)
+
+    def plan(self, n_vms, config):
+        return [(step.action, step.count) for step in main.plan(self.deployment(), self.shard[0], self.shard[1], n_vms,
+                                                                config)]
+
+
+class PlanTest(FakeDeploymentTestCase):
+
+    def test_nothing_to_do(self):
+        self.assertEqual(self.plan(2, vm_config()), [])
+
+    def test_missing_deployment(self):
+        steps = main.plan(None, "service", "deployment", 3, vm_config())
+        self.assertEqual([(step.action, step.count) for step in steps], [("add", 3)])
+
+    def test_add_and_remove(self):
+        self.assertEqual(self.plan(3, vm_config()), [("add", 1)])
+        self.assertEqual(self.plan(1, vm_config()), [("remove", 1)])
+
+    def test_drift(self):
+        self.assertEqual(self.plan(2, vm_config(size="Large")), [("remove", 1), ("remove", 1), ("add", 2)])
+
+    def test_state(self):
+        self.assertEqual(self.plan(2, vm_config(state="stopped")), [("stop", 2)])
+        main.stop(self.sms, self.tracker, *self.shard).result()
+        self.assertEqual(self.plan(2, vm_config(state="stopped")), [])
+        self.assertEqual(self.plan(2, vm_config()), [("start", 2)])
+
+
+class PortAllocatorTest(FakeDeploymentTestCase):
+
+    def test_from_deployment(self):
+        deployment = self.deployment()
+        used = set(int(endpoint.public_port) for instance in deployment.role_instance_list
+                   for endpoint in instance.instance_endpoints)
+        self.assertEqual(len(used), 3)  # Two SSH ports, and the load-balanced HTTP port.
+
+        allocator = main.PortAllocator.from_deployment(deployment)
+        allocated = set(allocator.allocate() for _ in range(100))
+        self.assertEqual(len(allocated), 100)
+        self.assertFalse(allocated & used)
+        for port in allocated:
+            self.assertTrue(main.PortAllocator.MIN_PORT <= port <= main.PortAllocator.MAX_PORT)
+
+
+class PortRangeTest(unittest.TestCase):
+
+    def test_range(self):
+        allocator = main.PortAllocator([5001])
+        allocator.reserve(5003)
+        self.assertEqual([allocator.allocate((5000, 5004)) for _ in range(3)], [5000, 5002, 5004])
+        self.assertRaises(ValueError, allocator.allocate, (5000, 5004))
+
+
+class ErrorsTest(unittest.TestCase):
+
+    def test_is_transient(self):
+        for error in (requests.exceptions.ConnectionError(), requests.exceptions.ReadTimeout(),
+                      requests.exceptions.ChunkedEncodingError(), WindowsAzureError("Unknown error (Gateway Timeout)")):
+            self.assertTrue(main.is_transient(error), error)
+            self.assertFalse(main.is_throttled(error), error)
+        self.assertTrue(main.is_throttled(WindowsAzureError("Unknown error (Service Unavailable)")))
+        self.assertFalse(main.is_transient(WindowsAzureConflictError("Conflict (Conflict)")))
+
+    def test_busy_with(self):
+        body = BUSY_BODY.format("0123abcd")
+        # The SDK drops the body of the response...
+        self.assertIsNone(main.busy_with(sdk_error(409, "Conflict", body)))
+        # ... so our HTTP client adds it to the message.
+        self.assertEqual(main.busy_with(sdk_error(409, "Conflict", body, main.keep_conflict_body)), "0123abcd")
+        self.assertIsNone(main.busy_with(sdk_error(409, "Conflict", CONFLICT_BODY, main.keep_conflict_body)))
+
+    def test_http_client(self):
+        def perform_request(client, request):
+            raise HTTPError(409, "Conflict", [], BUSY_BODY.format("0123abcd"))
+
+        sms = main.make_thread_safe(ServiceManagementService("subscription", request_session=requests.Session()))
+        original, _HTTPClient.perform_request = _HTTPClient.perform_request, perform_request
+        try:
+            with self.assertRaises(WindowsAzureConflictError) as context:
+                sms.start_roles("service", "deployment", ["role"])
+        finally:
+            _HTTPClient.perform_request = original
+        self.assertEqual(main.busy_with(context.exception), "0123abcd")
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_busy_deployment(self):
+        class Tracker(object):
+            tracked = []
+
+            def track(self, request_id, label=None):
+                self.tracked.append(request_id)
+                future = main.Future()
+                future.set_result(None)
+                return future
+
+        errors = [sdk_error(409, "Conflict", BUSY_BODY.format("0123abcd"), main.keep_conflict_body)]
+
+        def start_roles(service_name, deployment_name, role_names):
+            if errors:
+                raise errors.pop()
+            return AttrDict({"request_id": "4567ef"})
+
+        scheduler = main.RequestScheduler(rate=1000, burst=1000)
+        scheduler.tracker = Tracker()
+        self.assertEqual(scheduler.call("start_roles", start_roles, ("service", "deployment", ["role"]), {}).request_id,
+                         "4567ef")
+        self.assertEqual(Tracker.tracked, ["0123abcd"])
+
+        # Any other Conflict fails right away.
+        errors.append(sdk_error(409, "Conflict", CONFLICT_BODY, main.keep_conflict_body))
+        self.assertRaises(WindowsAzureConflictError, scheduler.call, "start_roles", start_roles,
+                          ("service", "deployment", ["role"]), {})
+
+
+class NonzeroRangesTest(unittest.TestCase):
+
+    def test_empty(self):
+        data = b"\0" * 8 * main.PAGE_SIZE
+        self.assertEqual(list(main.nonzero_ranges(data, len(data))), [])
+
+    def test_runs(self):
+        pages = [b"\0", b"a", b"b", b"\0", b"\0", b"c", b"\0", b"d"]
+        data = b"".join(page * main.PAGE_SIZE for page in pages)
+        page = main.PAGE_SIZE
+        self.assertEqual(list(main.nonzero_ranges(data, len(data))),
+                         [(1 * page, 3 * page), (5 * page, 6 * page), (7 * page, 8 * page)])
+        # Ranges don't span chunks.
+        self.assertEqual(list(main.nonzero_ranges(data, len(data), chunk_size=2 * page)),
+                         [(1 * page, 2 * page), (2 * page, 3 * page), (5 * page, 6 * page), (7 * page, 8 * page)])
+
+
+class PageRangesTest(unittest.TestCase):
+
+    def page_range(self, start, end):
+        page_range = PageRange()
+        page_range.start, page_range.end = str(start), str(end)
+        return page_range
+
+    def test_contains(self):
+        written = main._PageRanges([self.page_range(0, 1023), self.page_range(2048, 4095)])
+        self.assertIn((0, 512), written)
+        self.assertIn((0, 1024), written)
+        self.assertIn((3072, 4096), written)
+        self.assertNotIn((512, 1536), written)
+        self.assertNotIn((1024, 1536), written)
+        self.assertNotIn((3072, 4608), written)
+        self.assertNotIn((0, 512), main._PageRanges())
+
+
+if __name__ == "__main__":
+    unittest.main()